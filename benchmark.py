@@ -0,0 +1,753 @@
+import os
+import sys
+import csv
+import time
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import pysam
+from utils import *
+from pipeline import ZipCnvPipeline
+
+
+def write_synthetic_bam(filename, chr_len_list, read_len, n_reads, seed=0, events=(), flagged=0.0):
+    # Uniformly placed reads, coordinate-sorted and indexed.
+    # events: (chr_name, start, end, copy_ratio); the read density in [start, end) is scaled by copy_ratio.
+    # flagged: fraction of reads marked secondary, QC fail, duplicate or supplementary, all with random MAPQ
+    rng = np.random.default_rng(seed)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': chr_name, 'LN': chr_len} for chr_name, chr_len in chr_len_list]}
+    total_len = sum(chr_len for chr_name, chr_len in chr_len_list)
+    with pysam.AlignmentFile(filename, "wb", header=header) as file:
+        for tid, (chr_name, chr_len) in enumerate(chr_len_list):
+            n = int(n_reads * chr_len / total_len)
+            starts = rng.integers(0, chr_len - read_len, size=n)
+            for event_chr, event_start, event_end, copy_ratio in events:
+                if event_chr != chr_name:
+                    continue
+                inside = (starts >= event_start) & (starts < event_end)
+                if copy_ratio < 1:
+                    starts = starts[~inside | (rng.random(len(starts)) < copy_ratio)]
+                else:
+                    n_extra = rng.poisson((copy_ratio - 1) * n * (event_end - event_start) / chr_len)
+                    starts = np.append(starts, rng.integers(event_start, event_end, size=n_extra))
+            starts = np.sort(starts)
+            for i, start in enumerate(starts):
+                read = pysam.AlignedSegment(file.header)
+                read.query_name = f'r{tid}_{i}'
+                read.reference_id = tid
+                read.reference_start = int(start)
+                read.mapping_quality = int(rng.integers(0, 61)) if flagged else 60
+                if flagged and rng.random() < flagged:
+                    read.flag = int(rng.choice([0x100, 0x200, 0x400, 0x800]))
+                read.cigar = [(0, read_len)]
+                read.query_sequence = 'A' * read_len
+                file.write(read)
+    pysam.index(filename)
+
+
+def calcu_bam_dep_loop(chr_len_list, filename, read_len):
+    # Reference per-base implementation of calcu_bam_dep
+    sample_depth = {}
+    for chro in chr_len_list:
+        chro_name = chro[0]
+        chro_len = chro[1]
+        sample_depth[chro_name] = np.zeros(chro_len)
+    alignments = read_bam_file(filename)
+    for idx, sam in enumerate(alignments):
+        if sam['RNAME'] != '*':
+            chro_name = sam['RNAME']
+            pos = sam['POS']
+            for j in range(pos - 1, pos + read_len - 1):
+                sample_depth[chro_name][j] += 1
+    return sample_depth
+
+
+def read_bam_starts_loop(filename, chr_len_list, min_mapq=0, exclude_flags=0):
+    # Reference: read_bam_file records, filtered afterwards
+    read_starts = {chr_name: [] for chr_name, chr_len in chr_len_list}
+    for sam in read_bam_file(filename):
+        if sam['RNAME'] in read_starts and not sam['FLAG'] & exclude_flags and sam['MAPQ'] >= min_mapq:
+            read_starts[sam['RNAME']].append(sam['POS'] - 1)
+    return {chr_name: np.array(starts, dtype=np.int64) for chr_name, starts in read_starts.items()}
+
+
+def timed_peak(func, *args):
+    # Runtime, then peak Python allocations in a second, traced run (tracing slows allocations down)
+    res, rt = timed(func, *args)
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, rt, peak
+
+
+def timed(func, *args):
+    st = time.time()
+    res = func(*args)
+    return res, time.time() - st
+
+
+def bench_depth(args):
+    chr_len_list = [['chr1', args.chr_len], ['chr2', args.chr_len // 2]]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bam_file = os.path.join(tmp_dir, 'synthetic.bam')
+        write_synthetic_bam(bam_file, chr_len_list, args.read_len, args.reads)
+        old_depth, old_rt = timed(calcu_bam_dep_loop, chr_len_list, bam_file, args.read_len)
+        new_depth, new_rt = timed(calcu_bam_dep, chr_len_list, bam_file, args.read_len)
+
+    for chr_name, chr_len in chr_len_list:
+        assert np.array_equal(old_depth[chr_name], new_depth[chr_name]), f'depth mismatch on {chr_name}'
+    print(f'reads: {args.reads}, read_len: {args.read_len}')
+    print(f'per-base loop: {old_rt:.3f}sec')
+    print(f'difference array: {new_rt:.3f}sec ({old_rt / new_rt:.1f}x)')
+
+
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def bench_storage(args):
+    # Zero-inflated standardized depth, rounded like standardize_depth output
+    rng = np.random.default_rng(0)
+    standardized_depths = {}
+    for chr_name, chr_len in [['chr1', args.chr_len], ['chr2', args.chr_len // 2]]:
+        depth = rng.poisson(args.coverage, size=chr_len) * rng.uniform(0.5, 2.0, size=chr_len)
+        standardized_depths[chr_name] = np.round(depth, 2)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = os.path.join(tmp_dir, 'sample.json')
+        save2json(standardized_depths, json_file)
+        json_depth, json_rt = timed(load_from_json, json_file)
+        print(f'json: {dir_size(json_file) / 1e6:.1f}MB, load {json_rt:.3f}sec')
+
+        for dtype in ['float16', 'float32', 'float64']:
+            npy_dir = os.path.join(tmp_dir, f'sample_{dtype}')
+            save2npy(standardized_depths, npy_dir, dtype=dtype)
+            npy_depth, open_rt = timed(load_from_npy, npy_dir)
+            _, read_rt = timed(lambda: [np.asarray(d, dtype=np.float64) for d in npy_depth.values()])
+            max_err = max(np.max(np.abs(npy_depth[c] - json_depth[c])) for c in json_depth)
+            print(f'npy {dtype}: {dir_size(npy_dir) / 1e6:.1f}MB, mmap open {open_rt:.4f}sec, '
+                  f'full read {read_rt:.3f}sec, max abs error {max_err:.4g}')
+
+
+def calcu_win_depth_loop(data, pgg, window_size):
+    # Reference per-window implementation of zip_caller.calcu_win_depth
+    win_depth = []
+    for i in range(len(data) - window_size + 1):
+        x_bar = np.mean(data[i:i + window_size])
+        p_bar = np.mean(pgg[i:i + window_size])
+        s_bar = np.log(x_bar / p_bar)
+        win_depth.append(s_bar)
+    return win_depth
+
+
+def calcu_win_depth_prefix(data, pgg, window_size):
+    # Same computation as zip_caller.calcu_win_depth
+    x_bar = calcu_win_sum(data, window_size) / window_size
+    p_bar = calcu_win_sum(pgg, window_size) / window_size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log(x_bar / p_bar)
+
+
+def synthetic_std_depth(chr_len, coverage, seed=0):
+    # Zero-inflated standardized sample and baseline, rounded like standardize_depth output
+    rng = np.random.default_rng(seed)
+    data = np.round(rng.poisson(coverage, size=chr_len) * rng.uniform(0.5, 2.0, size=chr_len), 2)
+    pgg = np.mean([np.round(rng.poisson(coverage, size=chr_len) * 1.0, 2) for _ in range(5)], axis=0)
+    # A stretch without any reads in either
+    data[chr_len // 3:chr_len // 3 + 20000] = 0
+    pgg[chr_len // 3:chr_len // 3 + 20000] = 0
+    return data, pgg
+
+
+def bench_window(args):
+    data, pgg = synthetic_std_depth(args.chr_len, args.coverage)
+    for window_size in args.n:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            old, old_rt = timed(calcu_win_depth_loop, data, pgg, window_size)
+        new, new_rt = timed(calcu_win_depth_prefix, data, pgg, window_size)
+        old = np.array(old)
+        finite = np.isfinite(old)
+        same_pattern = np.array_equal(finite, np.isfinite(new)) and np.array_equal(old[~finite], new[~finite], equal_nan=True)
+        max_err = np.max(np.abs(old[finite] - new[finite])) if finite.any() else 0.0
+        print(f'-n {window_size}: loop {old_rt:.3f}sec, prefix sums {new_rt:.4f}sec ({old_rt / new_rt:.0f}x), '
+              f'max abs error {max_err:.3g}, identical inf/nan windows: {same_pattern}')
+
+
+def bench_windows(args):
+    # Several window sizes: one prefix-sum index per input vs calcu_win_sum per window size
+    data, pgg = synthetic_std_depth(args.chr_len, args.coverage)
+    window_sizes = sorted(args.n)
+    old, old_rt = timed(lambda: [calcu_win_depth_prefix(data, pgg, w) for w in window_sizes])
+    st = time.time()
+    data_index = calcu_win_index(data, window_sizes[-1])
+    pgg_index = calcu_win_index(pgg, window_sizes[-1])
+    index_rt = time.time() - st
+    new_rt = index_rt
+    report = []
+    for window_size, old_depth in zip(window_sizes, old):
+        st = time.time()
+        x_bar = index_win_sum(data_index, window_size) / window_size
+        p_bar = index_win_sum(pgg_index, window_size) / window_size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_depth = np.log(x_bar / p_bar)
+        win_rt = time.time() - st
+        new_rt += win_rt
+        finite = np.isfinite(old_depth)
+        same_pattern = np.array_equal(old_depth[~finite], new_depth[~finite], equal_nan=True)
+        max_err = np.max(np.abs(old_depth[finite] - new_depth[finite])) if finite.any() else 0.0
+        report.append(f'-n {window_size}: {win_rt:.3f}sec, max abs error {max_err:.3g}, '
+                      f'identical inf/nan windows: {same_pattern}')
+    print(f'{len(window_sizes)} window sizes on {args.chr_len} positions: calcu_win_sum per size {old_rt:.3f}sec, '
+          f'one index {new_rt:.3f}sec (index {index_rt:.3f}sec)')
+    print('\n'.join(report))
+
+
+def calcu_ct_loop(data, K):
+    # Reference per-position implementation of zip_caller.calcu_ct
+    ct_up = np.zeros(len(data))
+    ct_down = np.zeros(len(data))
+    for i in range(len(data)):
+        if i == 0:
+            ct_up[i] = 0
+            ct_down[i] = 0
+        else:
+            ct_up[i] = np.max([0, data[i] - K + ct_up[i - 1]])
+            ct_down[i] = np.min([0, data[i] + K + ct_down[i - 1]])
+    return ct_up, ct_down
+
+
+def bench_cusum(args):
+    for chr_idx, chr_len in enumerate(args.chr_len):
+        data, pgg = synthetic_std_depth(chr_len, args.coverage, seed=chr_idx)
+        win_depth = calcu_win_depth_prefix(data, pgg, args.n)
+        with np.errstate(invalid='ignore'):
+            old, old_rt = timed(calcu_ct_loop, win_depth, args.k)
+        report = f'chr_len {chr_len}: loop {old_rt:.3f}sec'
+        paths = [('numpy', False)] + ([('numba', True)] if numba is not None else [])
+        for name, use_numba in paths:
+            # The first call compiles the Numba kernel
+            calcu_cusum(win_depth[:10], args.k, use_numba=use_numba)
+            new, new_rt = timed(calcu_cusum, win_depth, args.k, use_numba)
+            same = all(np.array_equal(a, b, equal_nan=True) for a, b in zip(old, new))
+            report += f', {name} {new_rt:.4f}sec ({old_rt / new_rt:.0f}x, identical: {same})'
+        print(report)
+
+
+def find_continuous_up_segments(ct, H_pos, min_length):
+    # Reference implementation: one (i, num) tuple per position above threshold
+    up_segments = []
+    current_segment = []
+    for i, num in enumerate(ct):
+        if num >= H_pos:
+            current_segment.append((i, num))
+        else:
+            if len(current_segment) >= min_length:
+                up_segments.append(current_segment)
+            current_segment = []
+    if len(current_segment) >= min_length:
+        up_segments.append(current_segment)
+    return up_segments
+
+
+def find_continuous_down_segments(ct, H_neg, min_length):
+    down_segments = []
+    current_segment = []
+    for i, num in enumerate(ct):
+        if num <= H_neg:
+            current_segment.append((i, num))
+        else:
+            if len(current_segment) >= min_length:
+                down_segments.append(current_segment)
+            current_segment = []
+    if len(current_segment) >= min_length:
+        down_segments.append(current_segment)
+    return down_segments
+
+
+def find_cand_regs_loop(result, extreme, min_size=1000):
+    cand_cnv_regs = []
+    for res in result:
+        start = res[0][0]
+        end = extreme(res, key=lambda item: item[1])[0]
+        if end - start >= min_size:
+            cand_cnv_regs.append([start, end])
+    return cand_cnv_regs
+
+
+def find_cand_dup_regs_loop(ct_up, H_pos, min_length, min_size=1000):
+    return find_cand_regs_loop(find_continuous_up_segments(ct_up, H_pos, min_length), max, min_size)
+
+
+def find_cand_del_regs_loop(ct_down, H_neg, min_length, min_size=1000):
+    return find_cand_regs_loop(find_continuous_down_segments(ct_down, H_neg, min_length), min, min_size)
+
+
+def find_cand_dup_regs_runs(ct_up, H_pos, min_length, min_size=1000):
+    # Same as zip_caller.find_cand_dup_regs
+    return find_cand_regs(ct_up >= H_pos, ct_up, min_length, np.maximum, min_size)
+
+
+def find_cand_del_regs_runs(ct_down, H_neg, min_length, min_size=1000):
+    return find_cand_regs(ct_down <= H_neg, ct_down, min_length, np.minimum, min_size)
+
+
+def bench_segments(args):
+    # Parity on random statistics: ties, runs touching both ends, short runs, infinities
+    rng = np.random.default_rng(0)
+    for case in range(args.cases):
+        n = int(rng.integers(1, 3000))
+        ct = np.round(np.cumsum(rng.normal(0, 1, size=n)), int(rng.integers(0, 3)))
+        if case % 4 == 0:
+            ct[rng.integers(0, n, size=3)] = rng.choice([np.inf, -np.inf, np.nan], size=3)
+        threshold = float(rng.normal(0, 5))
+        min_length = int(rng.integers(1, 50))
+        min_size = int(rng.integers(0, 30))
+        assert find_cand_dup_regs_runs(ct, threshold, min_length, min_size) == \
+            find_cand_dup_regs_loop(ct, threshold, min_length, min_size), f'dup mismatch in case {case}'
+        assert find_cand_del_regs_runs(ct, threshold, min_length, min_size) == \
+            find_cand_del_regs_loop(ct, threshold, min_length, min_size), f'del mismatch in case {case}'
+    print(f'{args.cases} random cases: identical regions')
+
+    # Timing on a CUSUM statistic with long excursions
+    data, pgg = synthetic_std_depth(args.chr_len, args.coverage)
+    data[args.chr_len // 4:args.chr_len // 4 + args.chr_len // 5] *= 2
+    ct_up, ct_down = calcu_cusum(calcu_win_depth_prefix(data, pgg, 3000), 0.3)
+    H_pos = np.log2(1.5) * 3000
+    old, old_rt = timed(find_cand_dup_regs_loop, ct_up, H_pos, 10000)
+    new, new_rt = timed(find_cand_dup_regs_runs, ct_up, H_pos, 10000)
+    assert old == new
+    print(f'chr_len {args.chr_len}, {int(np.sum(ct_up >= H_pos))} positions above H_pos: '
+          f'tuple lists {old_rt:.3f}sec, runs {new_rt:.4f}sec ({old_rt / new_rt:.0f}x)')
+
+
+def bench_bam(args):
+    # Parsing a BAM: read_bam_file records vs read starts only, streamed or fetched through the index
+    # Contigs missing from chr_len.bed (decoys, unplaced) are only skipped by an indexed fetch
+    chr_len_list = [['chr1', args.chr_len], ['chr2', args.chr_len // 2], ['chrUn', args.chr_len], ['chrM', 16569]]
+    wanted = chr_len_list[:2]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bam_file = os.path.join(tmp_dir, 'synthetic.bam')
+        write_synthetic_bam(bam_file, chr_len_list, args.read_len, args.reads, flagged=0.1)
+        plain_file = os.path.join(tmp_dir, 'no_index.bam')
+        os.link(bam_file, plain_file)
+        ref, ref_rt, ref_peak = timed_peak(read_bam_starts_loop, bam_file, wanted, args.min_mapq, args.exclude_flags)
+        print(f'reads: {args.reads}, min_mapq {args.min_mapq}, exclude_flags {hex(args.exclude_flags)}, '
+              f'{sum(len(s) for s in ref.values())} reads kept on {len(wanted)} of {len(chr_len_list)} contigs')
+        print(f'read_bam_file: {ref_rt:.3f}sec, peak {ref_peak / 1e6:.1f}MB')
+        for name, filename, threads in [('stream', plain_file, 1), ('fetch', bam_file, 1),
+                                        (f'fetch, {args.threads} threads', bam_file, args.threads)]:
+            new, new_rt, new_peak = timed_peak(read_bam_starts, filename, wanted, threads, args.min_mapq,
+                                               args.exclude_flags)
+            assert all(np.array_equal(ref[c], new[c]) for c, l in wanted), f'read starts mismatch ({name})'
+            print(f'read_bam_starts ({name}): {new_rt:.3f}sec ({ref_rt / new_rt:.1f}x), '
+                  f'peak {new_peak / 1e6:.2f}MB ({ref_peak / max(new_peak, 1):.0f}x less)')
+
+
+def bench_sparse(args):
+    # Low-coverage BAM: per-base arrays vs runs of equal depth
+    chr_len_list = [['chr1', args.chr_len], ['chr2', args.chr_len // 2]]
+    n_reads = int(args.coverage * args.chr_len * 1.5 / args.read_len)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bam_file = os.path.join(tmp_dir, 'synthetic.bam')
+        write_synthetic_bam(bam_file, chr_len_list, args.read_len, n_reads)
+        dense, dense_rt = timed(calcu_bam_dep, chr_len_list, bam_file, args.read_len)
+        sparse, sparse_rt = timed(calcu_bam_dep, chr_len_list, bam_file, args.read_len, True)
+        save2npy(dense, os.path.join(tmp_dir, 'dense'), dtype=np.float32)
+        save2npy(sparse, os.path.join(tmp_dir, 'rle'), dtype=np.float32)
+        dense_disk = dir_size(os.path.join(tmp_dir, 'dense'))
+        rle_disk = dir_size(os.path.join(tmp_dir, 'rle'))
+
+    for chr_name, chr_len in chr_len_list:
+        assert np.array_equal(dense[chr_name], np.asarray(sparse[chr_name])), f'depth mismatch on {chr_name}'
+        assert np.median(dense[chr_name]) == sparse[chr_name].median(), f'median mismatch on {chr_name}'
+    dense_mb = sum(d.nbytes for d in dense.values()) / 1e6
+    rle_mb = sum(d.nbytes for d in sparse.values()) / 1e6
+    print(f'reads: {n_reads}, coverage: {args.coverage}x, runs: {sum(len(d.values) for d in sparse.values())}')
+    print(f'dense: {dense_mb:.1f}MB in memory, {dense_disk / 1e6:.1f}MB on disk, depth {dense_rt:.3f}sec')
+    print(f'rle: {rle_mb:.1f}MB in memory, {rle_disk / 1e6:.1f}MB on disk, depth {sparse_rt:.3f}sec')
+
+    data = dense['chr1']
+    for window_size in args.n:
+        old, old_rt, old_peak = timed_peak(calcu_win_sum, data, window_size)
+        new, new_rt, new_peak = timed_peak(calcu_win_sum, sparse['chr1'], window_size)
+        assert np.array_equal(old == 0, new == 0)
+        print(f'n={window_size}: dense {old_rt:.3f}sec peak {old_peak / 1e6:.1f}MB, '
+              f'rle {new_rt:.3f}sec peak {new_peak / 1e6:.1f}MB, max abs error {np.max(np.abs(old - new)):.3g}')
+
+
+def read_calls(output_dir):
+    # (sample, chromosome, start, end, cnv_type) of every call in the .cnv file of a zip_caller run
+    output_file = [os.path.join(output_dir, name) for name in os.listdir(output_dir) if name.endswith('.cnv')][0]
+    with open(output_file, 'r') as file:
+        rows = list(csv.reader(file, delimiter='\t'))[1:]
+    return [(row[0], row[1], int(row[2]), int(row[3]), row[5]) for row in rows]
+
+
+def overlaps(call, other, min_overlap=0.5):
+    # Same sample, chromosome and type, overlapping by at least min_overlap of both lengths
+    if call[0] != other[0] or call[1] != other[1] or call[4] != other[4]:
+        return False
+    overlap = min(call[3], other[3]) - max(call[2], other[2])
+    return overlap >= min_overlap * max(call[3] - call[2], other[3] - other[2], 1)
+
+
+def concordance(calls, ref_calls):
+    # Fraction of ref_calls matched by a call, None without ref_calls
+    if not ref_calls:
+        return None
+    return sum(any(overlaps(ref, call) for call in calls) for ref in ref_calls) / len(ref_calls)
+
+
+def run_script(run_dir, script, extra=()):
+    # One of the pipeline scripts with run_dir/run.config, in run_dir
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    st = time.time()
+    subprocess.run([sys.executable, os.path.join(package_dir, script), '-config', 'run.config'] + list(extra),
+                   cwd=run_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - st
+
+
+def run_script_rss(run_dir, script, extra=()):
+    # run_script, also returning the peak RSS of the script in MB
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    st = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(package_dir, script), '-config', 'run.config'] +
+                               list(extra), cwd=run_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, script)
+    # ru_maxrss is in kB on Linux
+    return time.time() - st, rusage.ru_maxrss / 1e3
+
+
+def run_pipeline(run_dir, config_lines):
+    # data_processing.py and zip_caller.py on the cohort described by config_lines, in their own directory
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, 'run.config'), 'w') as file:
+        file.write('\n'.join(config_lines) + '\n')
+    rt = run_script(run_dir, 'data_processing.py') + run_script(run_dir, 'zip_caller.py', ['-o', 'out/'])
+    return read_calls(os.path.join(run_dir, 'out')), rt
+
+
+def cohort_events(chr_len):
+    # Planted CNVs of every synthetic test sample: (chr_name, start, end, copy_ratio)
+    return [('chr1', chr_len // 5, chr_len // 5 + chr_len // 10, 1.5),
+            ('chr1', chr_len // 2, chr_len // 2 + chr_len // 8, 0.5),
+            ('chr2', chr_len // 8, chr_len // 8 + chr_len // 10, 1.5)]
+
+
+def plant_events(chr_len_list, n_events, min_len, max_len, seed=0):
+    # n_events non-overlapping dups (copy ratio 1.5) and dels (0.5) of min_len to max_len bases, at least max_len
+    # from each other and from the chromosome ends: (chr_name, start, end, copy_ratio), sorted
+    rng = np.random.default_rng(seed)
+    events = []
+    for _ in range(100 * n_events):
+        if len(events) == n_events:
+            break
+        chr_name, chr_len = chr_len_list[rng.integers(len(chr_len_list))]
+        length = int(rng.integers(min_len, max_len + 1))
+        if chr_len < 3 * max_len + length:
+            continue
+        start = int(rng.integers(max_len, chr_len - max_len - length))
+        if all(chr_name != other[0] or start >= other[2] + max_len or start + length + max_len <= other[1]
+               for other in events):
+            events.append((chr_name, start, start + length, float(rng.choice([1.5, 0.5]))))
+    return sorted(events)
+
+
+def latest_profile(run_dir, script_prefix):
+    # Stage report of the last run of a script in run_dir (see StageProfiler.write_report)
+    log_dir = os.path.join(run_dir, 'log')
+    reports = sorted(name for name in os.listdir(log_dir)
+                     if name.startswith(script_prefix + '_profile_') and name.endswith('.json'))
+    with open(os.path.join(log_dir, reports[-1]), 'r') as file:
+        return json.load(file)
+
+
+def write_synthetic_cohort(tmp_dir, args, chr_len_list=None, test_events=None):
+    # Baseline and test BAMs with their sample lists and chr_len bed; returns the config lines of the cohort.
+    # Defaults: chr1 of args.chr_len and a chr2 half as long, with cohort_events planted in every test sample;
+    # test_events holds the events of each test sample instead.
+    if chr_len_list is None:
+        chr_len_list = [['chr1', args.chr_len], ['chr2', args.chr_len // 2]]
+    if test_events is None:
+        test_events = [cohort_events(args.chr_len)] * args.tests
+    n_reads = int(args.coverage * sum(chr_len for chr_name, chr_len in chr_len_list) / args.read_len)
+    names = [f'baseline_{i}' for i in range(args.baselines)] + [f'test_{i}' for i in range(args.tests)]
+    for seed, name in enumerate(names):
+        events = test_events[int(name.split('_')[1])] if name.startswith('test') else ()
+        write_synthetic_bam(os.path.join(tmp_dir, f'{name}.bam'), chr_len_list, args.read_len, n_reads,
+                            seed=seed, events=events)
+    for list_name, prefix in [('baseline.csv', 'baseline'), ('test.csv', 'test')]:
+        with open(os.path.join(tmp_dir, list_name), 'w') as file:
+            file.write(',file_name,mapping\n')
+            files = [name for name in names if name.startswith(prefix)]
+            for i, name in enumerate(files):
+                file.write(f'{i},{os.path.join(tmp_dir, name + ".bam")},sample_{i}\n')
+    with open(os.path.join(tmp_dir, 'chr.bed'), 'w') as file:
+        for chr_name, chr_len in chr_len_list:
+            file.write(f'{chr_name}\t{chr_len}\n')
+    return [f"test_file_list = '{os.path.join(tmp_dir, 'test.csv')}'",
+            f"baseline_file_list = '{os.path.join(tmp_dir, 'baseline.csv')}'",
+            "baseline_save_path = 'data/baseline_save_path/'",
+            f"chr_len_path = '{os.path.join(tmp_dir, 'chr.bed')}'",
+            f"read_len = {args.read_len}",
+            "train_file_list = 0"]
+
+
+def bench_bins(args):
+    # Synthetic cohort with planted CNVs, called at every bin size; calls at bin_size 1 are the reference
+    truth = [(f'test_{i}.bam', chr_name, start, end, 'dup' if ratio > 1 else 'del')
+             for i in range(args.tests) for chr_name, start, end, ratio in cohort_events(args.chr_len)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_lines = write_synthetic_cohort(tmp_dir, args)
+        ref_calls = None
+        for bin_size in [1] + [b for b in args.bin_size if b != 1]:
+            run_dir = os.path.join(tmp_dir, f'bin_{bin_size}')
+            calls, rt = run_pipeline(run_dir, config_lines + [f"bin_size = {bin_size}"])
+            if ref_calls is None:
+                ref_calls = calls
+            nor_mb = sum(dir_size(os.path.join(run_dir, 'data', 'nor', name))
+                         for name in os.listdir(os.path.join(run_dir, 'data', 'nor'))) / 1e6
+            recall = concordance(calls, ref_calls)
+            precision = concordance(ref_calls, calls)
+            print(f'bin_size {bin_size}: {len(calls)} calls, data/nor {nor_mb:.2f}MB, {rt:.1f}sec, '
+                  f'planted events found {concordance(calls, truth):.2f}, '
+                  f'bin_size 1 calls found {recall if recall is None else round(recall, 2)}, '
+                  f'calls found at bin_size 1 {precision if precision is None else round(precision, 2)}')
+
+
+def bench_batch(args):
+    # zip_caller.py wall-clock and peak RSS on one synthetic cohort: one sample at a time vs samples x positions
+    # batches
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run_dir = os.path.join(tmp_dir, 'run')
+        run_pipeline(run_dir, write_synthetic_cohort(tmp_dir, args))
+        window_args = ['-n'] + [str(n) for n in args.n]
+        ref_rt, ref_rss = run_script_rss(run_dir, 'zip_caller.py', ['-o', 'per_sample/'] + window_args)
+        ref_calls = read_calls(os.path.join(run_dir, 'per_sample'))
+        print(f'{args.tests} test samples, chr_len {args.chr_len}, -n {args.n}: '
+              f'one sample at a time {ref_rt:.2f}sec, peak RSS {ref_rss:.0f}MB, {len(ref_calls)} calls')
+        for batch in args.batch:
+            out_dir = f'batch_{batch}/'
+            rt, rss = run_script_rss(run_dir, 'zip_caller.py', ['-o', out_dir, '-batch', str(batch)] + window_args)
+            calls = read_calls(os.path.join(run_dir, out_dir))
+            print(f'-batch {batch}: {rt:.2f}sec ({ref_rt / rt:.2f}x), peak RSS {rss:.0f}MB, '
+                  f'identical calls: {calls == ref_calls}')
+
+
+def bench_stream(args):
+    # zip_caller.py peak RSS and wall-clock on one long synthetic chromosome: whole chromosomes vs -chunk_size
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run_dir = os.path.join(tmp_dir, 'run')
+        run_pipeline(run_dir, write_synthetic_cohort(tmp_dir, args))
+        window_args = ['-n'] + [str(n) for n in args.n]
+        ref_rt, ref_rss = run_script_rss(run_dir, 'zip_caller.py', ['-o', 'whole/'] + window_args)
+        ref_calls = read_calls(os.path.join(run_dir, 'whole'))
+        print(f'{args.tests} test samples, chr_len {args.chr_len}, -n {args.n}: '
+              f'whole chromosomes {ref_rt:.2f}sec, peak RSS {ref_rss:.0f}MB, {len(ref_calls)} calls')
+        for chunk_size in args.chunk_size:
+            out_dir = f'chunk_{chunk_size}/'
+            rt, rss = run_script_rss(run_dir, 'zip_caller.py', ['-o', out_dir, '-chunk_size', str(chunk_size)] +
+                                     window_args)
+            calls = read_calls(os.path.join(run_dir, out_dir))
+            print(f'-chunk_size {chunk_size}: {rt:.2f}sec, peak RSS {rss:.0f}MB, '
+                  f'identical calls: {calls == ref_calls}')
+
+
+def bench_pipeline(args):
+    # data_processing.py and zip_caller.py end to end on a synthetic sWGS cohort: chr_len.bed scaled down by
+    # -scale, different planted dups and dels in every test sample. Reports the time, peak RSS and stage totals
+    # of both scripts and how the calls agree with the planted events.
+    chr_len_list = [[chr_name, chr_len // args.scale] for chr_name, chr_len in read_chr_len_file(args.bed)]
+    test_events = [plant_events(chr_len_list, args.events, args.min_event, args.max_event, seed=1000 + i)
+                   for i in range(args.tests)]
+    truth = [(f'test_{i}.bam', chr_name, start, end, 'dup' if ratio > 1 else 'del')
+             for i, events in enumerate(test_events) for chr_name, start, end, ratio in events]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.keep or tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        st = time.time()
+        config_lines = write_synthetic_cohort(data_dir, args, chr_len_list, test_events)
+        print(f'{args.baselines} baselines + {args.tests} tests, {len(chr_len_list)} chromosomes of '
+              f'{sum(chr_len for chr_name, chr_len in chr_len_list) / 1e6:.1f}Mb, {len(truth)} planted events, '
+              f'BAMs written in {time.time() - st:.1f}sec')
+
+        run_dir = os.path.join(data_dir, 'run')
+        os.makedirs(run_dir, exist_ok=True)
+        with open(os.path.join(run_dir, 'run.config'), 'w') as file:
+            file.write('\n'.join(config_lines + args.config) + '\n')
+        report = {'args': {key: value for key, value in vars(args).items() if key != 'func'}, 'truth': truth,
+                  'scripts': {}}
+        for script, extra in [('data_processing.py', ['-workers', str(args.workers)]),
+                              ('zip_caller.py', ['-o', 'out/', '-workers', str(args.workers), '-n'] +
+                               [str(n) for n in args.n])]:
+            rt, rss = run_script_rss(run_dir, script, extra)
+            profile = latest_profile(run_dir, 'data_processing' if script == 'data_processing.py' else 'ZIP-Caller')
+            report['scripts'][script] = {'sec': rt, 'peak_rss_mb': rss, 'stages': profile['stages']}
+            print(f'{script}: {rt:.2f}sec, peak RSS {rss:.0f}MB')
+            for stage, total in profile['stages'].items():
+                line = f"  {stage:<16}{total['count']:>6} units {total['sec']:>9.3f}sec"
+                if 'reads_per_sec' in total:
+                    line += f", {total['reads_per_sec'] / 1e6:.2f}M reads/sec"
+                if total.get('read_mb') or total.get('write_mb'):
+                    line += f", read {total.get('read_mb', 0):.1f}MB, wrote {total.get('write_mb', 0):.1f}MB"
+                print(line)
+
+        if args.in_process:
+            # The same run through ZipCnvPipeline, without writing data/nor or reading it back
+            pipeline = ZipCnvPipeline.from_config(os.path.join(run_dir, 'run.config'), slide_wins=args.n,
+                                                  workers=args.workers, log_dir=os.path.join(run_dir, 'log'))
+            file_lists = {}
+            for list_name in ['test', 'baseline']:
+                with open(os.path.join(data_dir, f'{list_name}.csv'), 'r') as file:
+                    file_lists[list_name] = [row['file_name'] for row in csv.DictReader(file)]
+            in_process_file = os.path.join(run_dir, 'in_process', 'calls.cnv')
+            _, rt = timed(pipeline.run, file_lists['test'], file_lists['baseline'], (), in_process_file)
+            identical = read_calls(os.path.dirname(in_process_file)) == read_calls(os.path.join(run_dir, 'out'))
+            report['in_process'] = {'sec': rt, 'identical_calls': identical}
+            print(f'ZipCnvPipeline in process: {rt:.2f}sec, identical calls: {identical}')
+
+        # Calls of every window size, once per region
+        calls = sorted(set(read_calls(os.path.join(run_dir, 'out'))))
+        report['concordance'] = {}
+        for cnv_type in ['dup', 'del', None]:
+            type_truth = [event for event in truth if cnv_type in (None, event[4])]
+            type_calls = [call for call in calls if cnv_type in (None, call[4])]
+            sensitivity = concordance(type_calls, type_truth)
+            precision = concordance(type_truth, type_calls)
+            report['concordance'][cnv_type or 'all'] = {'events': len(type_truth), 'calls': len(type_calls),
+                                                        'sensitivity': sensitivity, 'precision': precision}
+            print(f"{cnv_type or 'all'}: {len(type_truth)} planted, {len(type_calls)} calls, "
+                  f"sensitivity {sensitivity if sensitivity is None else round(sensitivity, 2)}, "
+                  f"precision {precision if precision is None else round(precision, 2)}")
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    depth_parser = subparsers.add_parser('depth', help="calcu_bam_dep: per-base loop vs difference array")
+    depth_parser.add_argument('-reads', type=int, default=100000, help="Number of synthetic reads")
+    depth_parser.add_argument('-read_len', type=int, default=100, help="The length of reads")
+    depth_parser.add_argument('-chr_len', type=int, default=5000000, help="Length of the synthetic chr1")
+    depth_parser.set_defaults(func=bench_depth)
+
+    storage_parser = subparsers.add_parser('storage', help="data/nor storage: JSON vs memory-mapped .npy")
+    storage_parser.add_argument('-chr_len', type=int, default=5000000, help="Length of the synthetic chr1")
+    storage_parser.add_argument('-coverage', type=float, default=0.5, help="Mean depth of the synthetic sample")
+    storage_parser.set_defaults(func=bench_storage)
+
+    window_parser = subparsers.add_parser('window', help="calcu_win_depth: per-window loop vs prefix sums")
+    window_parser.add_argument('-chr_len', type=int, default=200000, help="Length of the synthetic chromosome")
+    window_parser.add_argument('-coverage', type=float, default=0.5, help="Mean depth of the synthetic sample")
+    window_parser.add_argument('-n', type=int, nargs='+', default=[500, 1000, 3000, 10000], help="Sliding window sizes")
+    window_parser.set_defaults(func=bench_window)
+
+    windows_parser = subparsers.add_parser('windows', help="Several window sizes: one prefix-sum index vs one per size")
+    windows_parser.add_argument('-chr_len', type=int, default=5000000, help="Length of the synthetic chromosome")
+    windows_parser.add_argument('-coverage', type=float, default=0.5, help="Mean depth of the synthetic sample")
+    windows_parser.add_argument('-n', type=int, nargs='+', default=[1000, 2000, 3000, 5000, 10000, 20000],
+                                help="Sliding window sizes")
+    windows_parser.set_defaults(func=bench_windows)
+
+    cusum_parser = subparsers.add_parser('cusum', help="calcu_ct: per-position loop vs NumPy / Numba kernels")
+    cusum_parser.add_argument('-chr_len', type=int, nargs='+', default=[100000, 200000],
+                              help="Lengths of the synthetic chromosomes")
+    cusum_parser.add_argument('-coverage', type=float, default=0.5, help="Mean depth of the synthetic sample")
+    cusum_parser.add_argument('-n', type=int, default=3000, help="Sliding window size")
+    cusum_parser.add_argument('-k', type=float, default=0.3, help="The reference value for the allowed degree of deviation.")
+    cusum_parser.set_defaults(func=bench_cusum)
+
+    segments_parser = subparsers.add_parser('segments', help="Candidate regions: tuple lists vs run detection")
+    segments_parser.add_argument('-cases', type=int, default=2000, help="Number of random parity cases")
+    segments_parser.add_argument('-chr_len', type=int, default=2000000, help="Length of the synthetic chromosome")
+    segments_parser.add_argument('-coverage', type=float, default=0.5, help="Mean depth of the synthetic sample")
+    segments_parser.set_defaults(func=bench_segments)
+
+    bam_parser = subparsers.add_parser('bam', help="BAM parsing: read_bam_file vs indexed read_bam_starts with filters")
+    bam_parser.add_argument('-reads', type=int, default=200000, help="Number of synthetic reads")
+    bam_parser.add_argument('-read_len', type=int, default=100, help="The length of reads")
+    bam_parser.add_argument('-chr_len', type=int, default=5000000, help="Length of the synthetic chr1")
+    bam_parser.add_argument('-min_mapq', type=int, default=20, help="Minimum MAPQ of counted reads")
+    bam_parser.add_argument('-exclude_flags', type=lambda x: int(x, 0), default=0x704,
+                            help="Reads with any of these SAM flags are not counted")
+    bam_parser.add_argument('-threads', type=int, default=4, help="htslib decompression threads")
+    bam_parser.set_defaults(func=bench_bam)
+
+    sparse_parser = subparsers.add_parser('sparse', help="Depth storage: per-base arrays vs RunLengthDepth")
+    sparse_parser.add_argument('-chr_len', type=int, default=20000000, help="Length of the synthetic chr1")
+    sparse_parser.add_argument('-coverage', type=float, default=0.1, help="Mean depth of the synthetic sample")
+    sparse_parser.add_argument('-read_len', type=int, default=100, help="The length of reads")
+    sparse_parser.add_argument('-n', type=int, nargs='+', default=[1000, 3000, 10000], help="Sliding window sizes")
+    sparse_parser.set_defaults(func=bench_sparse)
+
+    bins_parser = subparsers.add_parser('bins', help="Call concordance of binned depths against bin_size 1")
+    bins_parser.add_argument('-bin_size', type=int, nargs='+', default=[10, 100, 1000], help="Bin sizes to compare")
+    bins_parser.add_argument('-chr_len', type=int, default=2000000, help="Length of the synthetic chr1")
+    bins_parser.add_argument('-coverage', type=float, default=1.0, help="Mean depth of the synthetic samples")
+    bins_parser.add_argument('-read_len', type=int, default=100, help="The length of reads")
+    bins_parser.add_argument('-baselines', type=int, default=10, help="Number of baseline samples")
+    bins_parser.add_argument('-tests', type=int, default=3, help="Number of test samples, each with the planted CNVs")
+    bins_parser.set_defaults(func=bench_bins)
+
+    batch_parser = subparsers.add_parser('batch', help="zip_caller.py: one sample at a time vs -batch")
+    batch_parser.add_argument('-batch', type=int, nargs='+', default=[4, 16], help="Batch sizes to compare")
+    batch_parser.add_argument('-n', type=int, nargs='+', default=[3000], help="Sliding window sizes")
+    batch_parser.add_argument('-chr_len', type=int, default=2000000, help="Length of the synthetic chr1")
+    batch_parser.add_argument('-coverage', type=float, default=0.5, help="Mean depth of the synthetic samples")
+    batch_parser.add_argument('-read_len', type=int, default=100, help="The length of reads")
+    batch_parser.add_argument('-baselines', type=int, default=10, help="Number of baseline samples")
+    batch_parser.add_argument('-tests', type=int, default=16, help="Number of test samples")
+    batch_parser.set_defaults(func=bench_batch)
+
+    stream_parser = subparsers.add_parser('stream', help="zip_caller.py: whole chromosomes vs -chunk_size")
+    stream_parser.add_argument('-chunk_size', type=int, nargs='+', default=[1000000, 200000],
+                               help="Chunk sizes to compare")
+    stream_parser.add_argument('-n', type=int, nargs='+', default=[3000], help="Sliding window sizes")
+    stream_parser.add_argument('-chr_len', type=int, default=20000000, help="Length of the synthetic chr1")
+    stream_parser.add_argument('-coverage', type=float, default=0.2, help="Mean depth of the synthetic samples")
+    stream_parser.add_argument('-read_len', type=int, default=100, help="The length of reads")
+    stream_parser.add_argument('-baselines', type=int, default=4, help="Number of baseline samples")
+    stream_parser.add_argument('-tests', type=int, default=2, help="Number of test samples")
+    stream_parser.set_defaults(func=bench_stream)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help="End to end on a synthetic cohort with planted CNVs")
+    pipeline_parser.add_argument('-bed', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                        'chr_len.bed'),
+                                 help="Chromosome lengths to scale down")
+    pipeline_parser.add_argument('-scale', type=int, default=100, help="Divide the chromosome lengths by this")
+    pipeline_parser.add_argument('-coverage', type=float, default=0.5, help="Mean depth of the synthetic samples")
+    pipeline_parser.add_argument('-read_len', type=int, default=100, help="The length of reads")
+    pipeline_parser.add_argument('-baselines', type=int, default=10, help="Number of baseline samples")
+    pipeline_parser.add_argument('-tests', type=int, default=4, help="Number of test samples")
+    pipeline_parser.add_argument('-events', type=int, default=6, help="Planted CNVs per test sample")
+    pipeline_parser.add_argument('-min_event', type=int, default=50000, help="Shortest planted CNV")
+    pipeline_parser.add_argument('-max_event', type=int, default=200000, help="Longest planted CNV")
+    pipeline_parser.add_argument('-n', type=int, nargs='+', default=[3000], help="Sliding window sizes")
+    pipeline_parser.add_argument('-workers', type=int, default=1, help="-workers of both scripts")
+    pipeline_parser.add_argument('-config', type=str, nargs='*', default=[],
+                                 help="Extra config lines, e.g. \"bin_size = 100\"")
+    pipeline_parser.add_argument('-in_process', action='store_true',
+                                 help="Also run ZipCnvPipeline in this process and compare its calls")
+    pipeline_parser.add_argument('-keep', type=str, help="Write the cohort and the run here instead of a temporary "
+                                                         "directory")
+    pipeline_parser.add_argument('-report', type=str, help="Also write the results to this JSON file")
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,85 +1,368 @@
 from collections import defaultdict
 import pandas as pd
 import time
-from tqdm import trange
+from tqdm import tqdm, trange
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 from datetime import datetime
 from utils import *
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-config', type=str, help="Path to the '.config' file ", required=True)
-args = parser.parse_args()
 
-
-def standardize_depth(sample_depths, chr_len_list, epsilon=1e-6, save_filename="rj_means_and_n.json"):
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', type=str, help="Path to the '.config' file ", required=True)
+    parser.add_argument('-workers', type=int, default=1, help="Number of processes used to compute sample depths")
+    parser.add_argument('-bam_threads', type=int, default=1, help="htslib decompression threads per BAM")
+    parser.add_argument('-block_size', type=int, default=0,
+                        help="Standardize in genomic blocks of this many bases (0: whole chromosomes in memory)")
+    parser.add_argument('-update_baseline', action='store_true',
+                        help="Fold the baseline samples into the existing baseline store instead of rebuilding it")
+    parser.add_argument('-sumsq', action='store_true',
+                        help="Also keep per-position sums of squares in the baseline store")
+    parser.add_argument('-merge_baseline', type=str, nargs='+',
+                        help="Merge these baseline stores into baseline_save_path and exit")
+    parser.add_argument('-profile', action='store_true',
+                        help="Run under cProfile and write the hotspot stats to log/")
+    parser.add_argument('-checkpoint', type=str,
+                        help="Record finished units in this directory and resume from them after a restart")
+    parser.add_argument('-shard', type=parse_shard,
+                        help="Run shard i/N (0 <= i < N) of the job, e.g. the SLURM array task $SLURM_ARRAY_TASK_ID")
+    parser.add_argument('-shard_by', choices=['chromosome', 'sample'], default='chromosome',
+                        help="chromosome: depths, standardization and a partial baseline store of every N-th "
+                             "chromosome; sample: only the depths of every N-th sample, into the depth cache")
+    parser.add_argument('-merge_shards', type=int, metavar='N',
+                        help="Merge the outputs of the N chromosome shards into baseline_save_path and exit")
+    args = parser.parse_args(argv)
+    if args.shard and args.update_baseline:
+        parser.error('-update_baseline cannot be combined with -shard')
+    return args
+
+
+def standardize_depth(sample_depths, chr_len_list, epsilon=1e-6, save_dir="rj_means_and_n"):
+    # The per-position means are written as save_dir/<chr>.npy, as standardize_depth_blocked writes them.
+    # With save_dir None they are not written.
     standardized_depths = defaultdict(dict)
-    rj_means_dict = {}
     n_samples = len(sample_depths)
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
 
     for chr_name, chr_len in chr_len_list:
-        # Collect depths for all samples at this chromosome
-        all_samples_depth = np.array([sample_depth[chr_name] for sample_depth in sample_depths])
+        with profiler.stage('standardize', chromosome=chr_name):
+            # Collect depths for all samples at this chromosome
+            all_samples_depth = np.array([sample_depth[chr_name] for sample_depth in sample_depths], dtype=np.float64)
 
-        # Compute Rj^mode for each sample, adding epsilon to avoid division by zero
-        Rj_median = np.median(all_samples_depth, axis=1) + epsilon
+            # Compute Rj^mode for each sample, adding epsilon to avoid division by zero
+            Rj_median = np.median(all_samples_depth, axis=1) + epsilon
 
-        # Compute Ri·^mean for each position, adding epsilon to avoid division by zero
-        Ri_means = np.mean(all_samples_depth, axis=0) + epsilon
+            # Compute Ri·^mean for each position, adding epsilon to avoid division by zero
+            Ri_means = np.mean(all_samples_depth, axis=0) + epsilon
 
-        rj_means_dict[chr_name] = {
-            "Rj_means": Ri_means.tolist(),  # 转换为列表格式
-            "n_samples": n_samples
-        }
+            if save_dir is not None:
+                with profiler.stage('rj_means_write', chromosome=chr_name):
+                    np.save(os.path.join(save_dir, f'{chr_name}.npy'), Ri_means)
 
-        for sample_idx, sample_depth in enumerate(all_samples_depth):
-            # Standardize depth
-            standardized_depth = (sample_depth / Rj_median[sample_idx]) / Ri_means
-            standardized_depths[sample_idx][chr_name] = np.round(standardized_depth, 2)
+            for sample_idx, sample_depth in enumerate(all_samples_depth):
+                # Standardize depth
+                standardized_depth = (sample_depth / Rj_median[sample_idx]) / Ri_means
+                standardized_depths[sample_idx][chr_name] = np.round(standardized_depth, 2)
 
-    with open(save_filename, "w") as f:
-        json.dump(rj_means_dict, f, indent=4)
+    if save_dir is not None:
+        with open(os.path.join(save_dir, "n_samples.json"), "w") as f:
+            json.dump({chr_name: n_samples for chr_name, chr_len in chr_len_list}, f, indent=4)
 
     return standardized_depths
 
 
-def get_std_dep(df, chr_len_list, read_len, log_filename):
-    sample_depths = []
-    for i in trange(df.shape[0]):
+def calcu_hist_median(hist, n):
+    # Exact median of n non-negative integers given their histogram
+    cum_hist = np.cumsum(hist)
+    lower = np.searchsorted(cum_hist, (n - 1) // 2, side='right')
+    upper = np.searchsorted(cum_hist, n // 2, side='right')
+    return (lower + upper) / 2
+
+
+def standardize_depth_blocked(sample_depths, chr_len_list, out_dirs, block_size, epsilon=1e-6,
+                              save_dir="rj_means_and_n", dtype=np.float32):
+    # Same result as standardize_depth, but only block_size positions of every sample are in memory at once.
+    # sample_depths hold integer read depths (memory-mapped), standardized depths are written to out_dirs.
+    n_samples = len(sample_depths)
+    os.makedirs(save_dir, exist_ok=True)
+    for out_dir in out_dirs:
+        os.makedirs(out_dir, exist_ok=True)
+
+    for chr_name, chr_len in chr_len_list:
+        with profiler.stage('standardize', chromosome=chr_name):
+            blocks = range(0, chr_len, block_size)
+
+            # Pass 1: exact Rj^mode of each sample from a histogram of its depths
+            Rj_median = np.zeros(n_samples)
+            for sample_idx, sample_depth in enumerate(sample_depths):
+                if not np.issubdtype(sample_depth[chr_name].dtype, np.integer):
+                    # Bin means are not integers, but a chromosome of bins is small enough to load
+                    Rj_median[sample_idx] = np.median(np.asarray(sample_depth[chr_name]))
+                    continue
+                hist = np.zeros(1, dtype=np.int64)
+                for start in blocks:
+                    block_hist = np.bincount(sample_depth[chr_name][start:start + block_size])
+                    if len(block_hist) > len(hist):
+                        hist = np.pad(hist, (0, len(block_hist) - len(hist)))
+                    hist[:len(block_hist)] += block_hist
+                Rj_median[sample_idx] = calcu_hist_median(hist, chr_len)
+            Rj_median += epsilon
+
+            # Pass 2: Ri·^mean and the standardized depth, block by block
+            Ri_means = np.lib.format.open_memmap(os.path.join(save_dir, f'{chr_name}.npy'), mode='w+',
+                                                 dtype=np.float64, shape=(chr_len,))
+            outputs = [np.lib.format.open_memmap(os.path.join(out_dir, f'{chr_name}.npy'), mode='w+',
+                                                 dtype=dtype, shape=(chr_len,)) for out_dir in out_dirs]
+            for start in blocks:
+                end = min(start + block_size, chr_len)
+                all_samples_block = np.array([sample_depth[chr_name][start:end] for sample_depth in sample_depths],
+                                             dtype=np.float64)
+                block_means = np.mean(all_samples_block, axis=0) + epsilon
+                Ri_means[start:end] = block_means
+                for sample_idx, sample_block in enumerate(all_samples_block):
+                    standardized_depth = (sample_block / Rj_median[sample_idx]) / block_means
+                    outputs[sample_idx][start:end] = np.round(standardized_depth, 2)
+            Ri_means.flush()
+            for output in outputs:
+                output.flush()
+            del Ri_means, outputs
+            # A run-length file from an earlier run would be read instead of the new .npy
+            for out_dir in out_dirs:
+                rle_file = os.path.join(out_dir, f'{chr_name}.rle.npz')
+                if os.path.isfile(rle_file):
+                    os.remove(rle_file)
+
+    with open(os.path.join(save_dir, "n_samples.json"), "w") as f:
+        json.dump({chr_name: n_samples for chr_name, chr_len in chr_len_list}, f, indent=4)
+
+
+def standardize_depth_sparse(sample_depths, chr_len_list, epsilon=1e-6, save_dir="rj_means_and_n"):
+    # Same result as standardize_depth for RunLengthDepth inputs, without expanding them to per-base arrays.
+    # With save_dir None the per-position means are not written.
+    standardized_depths = defaultdict(dict)
+    n_samples = len(sample_depths)
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    for chr_name, chr_len in chr_len_list:
+        with profiler.stage('standardize', chromosome=chr_name):
+            # Compute Rj^mode for each sample from its runs
+            Rj_median = [sample_depth[chr_name].median() + epsilon for sample_depth in sample_depths]
+
+            # Compute Ri·^mean for each position, summing the samples in the same order as np.mean
+            Ri_sum = sample_depths[0][chr_name] * 1.0
+            for sample_depth in sample_depths[1:]:
+                Ri_sum = Ri_sum + sample_depth[chr_name]
+            Ri_means = Ri_sum / n_samples + epsilon
+            if save_dir is not None:
+                Ri_means.save(os.path.join(save_dir, f'{chr_name}.rle.npz'))
+
+            for sample_idx, sample_depth in enumerate(sample_depths):
+                standardized_depth = (sample_depth[chr_name] / Rj_median[sample_idx]) / Ri_means
+                standardized_depths[sample_idx][chr_name] = standardized_depth.round(2)
+
+    if save_dir is not None:
+        with open(os.path.join(save_dir, "n_samples.json"), "w") as f:
+            json.dump({chr_name: n_samples for chr_name, chr_len in chr_len_list}, f, indent=4)
+
+    return standardized_depths
+
+
+def calcu_sample_dep(chr_len_list, filename, read_len, raw_dir=None, sparse=False, bin_size=1, bam_options=None):
+    # With raw_dir the depth is written to disk and only its directory is returned.
+    # bam_options: threads, min_mapq and exclude_flags of read_bam_starts
+    bam_options = bam_options or {}
+    if raw_dir is None:
+        return calcu_bam_dep(chr_len_list, filename, read_len, sparse, bin_size, **bam_options)
+    return save_bam_dep(chr_len_list, filename, read_len, raw_dir, sparse, bin_size, **bam_options)
+
+
+def record_depth_units(checkpoint, filename, out_dir, chr_len_list):
+    # Record the raw depth files of these chromosomes of a sample, and the BAM they were read from, in the checkpoint
+    if checkpoint is not None:
+        for chr_name, chr_len in chr_len_list:
+            checkpoint.complete(os.path.basename(filename), 'depth', chr_name, [depth_file_path(out_dir, chr_name)],
+                                inputs=[filename])
+
+
+def split_bam_units(filename, chr_len_list):
+    # Indexed BAMs are read one chromosome per unit, others in one pass
+    try:
+        if has_bam_index(filename):
+            return [[chro] for chro in chr_len_list]
+    except Exception:
+        pass
+    return [chr_len_list]
+
+
+def merge_rj_means(shards, chr_len_list):
+    # Per-position means written by the chromosome shards, combined as one run writes them
+    n_samples = {}
+    os.makedirs('rj_means_and_n', exist_ok=True)
+    for shard in shards:
+        shard_dir = f'rj_means_and_n_{shard}'
+        if not os.path.isdir(shard_dir):
+            raise FileNotFoundError(f'The per-position means of {shard} are missing')
+        with open(os.path.join(shard_dir, 'n_samples.json'), 'r') as f:
+            n_samples.update(json.load(f))
+        for file_name in os.listdir(shard_dir):
+            if file_name != 'n_samples.json':
+                shutil.copyfile(os.path.join(shard_dir, file_name), os.path.join('rj_means_and_n', file_name))
+    with open(os.path.join('rj_means_and_n', 'n_samples.json'), 'w') as f:
+        json.dump({chr_name: n_samples[chr_name] for chr_name, chr_len in chr_len_list}, f, indent=4)
+
+
+def sample_checkpoint_key(samples):
+    # Checkpoint key of one cohort: the identity of its BAMs (input_identity) or its sample names
+    return 'cohort-' + hashlib.sha256(json.dumps(samples, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_std_dep(df, chr_len_list, read_len, log_filename, workers=1, raw_dir=None, sparse=False, bin_size=1,
+                bam_options=None, cache_dir=None, cache_max_mb=0, checkpoint=None):
+    # With a checkpoint (raw depths written to raw_dir or the depth cache), every (sample, chromosome) raw depth
+    # is recorded as soon as it is written, and chromosomes recorded by a stopped run are not read again
+    filenames = []
+    for i in range(df.shape[0]):
         mapping = f"sample_{i}"
         filename = df.loc[df['mapping'] == mapping]['file_name'].values[0]
-        print(f'process {filename} ..................')
         if os.path.isfile(filename):
+            filenames.append(filename)
+
+    results = [None] * len(filenames)
+    # Where the raw depth of each sample is written: its depth cache entry, raw_dir, or None to keep it in memory
+    sample_raw_dirs = [raw_dir] * len(filenames)
+    todo = list(range(len(filenames)))
+    cache_fields = {}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        options = bam_options or {}
+        todo = []
+        for idx, filename in enumerate(filenames):
+            key, fields = depth_cache_key(filename, chr_len_list, read_len, sparse, bin_size,
+                                          options.get('min_mapq', 0), options.get('exclude_flags', 0))
+            sample_raw_dirs[idx] = os.path.join(cache_dir, key)
+            if depth_cache_hit(sample_raw_dirs[idx]):
+                results[idx] = os.path.join(sample_raw_dirs[idx], os.path.basename(filename).replace('.bam', ''))
+            elif sample_raw_dirs[idx] not in cache_fields:
+                cache_fields[sample_raw_dirs[idx]] = fields
+                todo.append(idx)
+
+    # Chromosomes still to be read for each sample
+    sample_chrs = [chr_len_list] * len(filenames)
+    if checkpoint is not None:
+        for idx in todo:
+            sample = os.path.basename(filenames[idx])
+            sample_chrs[idx] = [chro for chro in chr_len_list
+                                if not checkpoint.done(sample, 'depth', chro[0], [filenames[idx]])]
+            if not sample_chrs[idx]:
+                results[idx] = os.path.join(sample_raw_dirs[idx], sample.replace('.bam', ''))
+
+    if workers <= 1:
+        for idx in tqdm(todo):
+            filename = filenames[idx]
+            if not sample_chrs[idx]:
+                continue
+            print(f'process {filename} ..................')
             try:
-                sample_depth = calcu_bam_dep(chr_len_list, filename, read_len)
-                sample_depths.append(sample_depth)
+                results[idx] = calcu_sample_dep(sample_chrs[idx], filename, read_len, sample_raw_dirs[idx], sparse,
+                                                bin_size, bam_options)
+                record_depth_units(checkpoint, filename, results[idx], sample_chrs[idx])
             except Exception as e:
-                current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-                error_message = f"{current_time}:Error occurred while reading {filename}: {e}"
-                print(error_message)
-                # Write the error message to the log file
-                with open(log_filename, "a") as log_file:
-                    log_file.write(error_message + "\n")
-                continue
-    return sample_depths
-
-
-def save2json(standardized_depths, filename):
-    # Convert numpy arrays to lists for JSON serialization
-    standardized_depths_serializable = {}
-    for chr_name, standardized_depth in standardized_depths.items():
-        standardized_depths_serializable[chr_name] = standardized_depth.tolist()
-
-    # Write to JSON file
-    with open(filename, 'w') as jsonfile:
-        json.dump(standardized_depths_serializable, jsonfile)
+                log_error(log_filename, filename, e)
+    else:
+        # Fan (sample, chromosome) units out to a process pool; results are kept in sample_i order
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            future_units = {}
+            for idx in todo:
+                filename = filenames[idx]
+                if not sample_chrs[idx]:
+                    continue
+                for unit in split_bam_units(filename, sample_chrs[idx]):
+                    future = executor.submit(run_profiled, calcu_sample_dep, unit, filename, read_len,
+                                             sample_raw_dirs[idx], sparse, bin_size, bam_options)
+                    futures[future] = idx
+                    future_units[future] = unit
+            parts = [[] for _ in filenames]
+            remaining = [0] * len(filenames)
+            for idx in futures.values():
+                remaining[idx] += 1
+            failed = set()
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                idx = futures[future]
+                remaining[idx] -= 1
+                try:
+                    part, records = future.result()
+                    profiler.records += records
+                    parts[idx].append(part)
+                    record_depth_units(checkpoint, filenames[idx], part, future_units[future])
+                except Exception as e:
+                    if idx not in failed:
+                        log_error(log_filename, filenames[idx], e)
+                    failed.add(idx)
+                if remaining[idx] == 0 and idx not in failed:
+                    print(f'process {filenames[idx]} ..................')
+                    if sample_raw_dirs[idx] is not None:
+                        # Every unit wrote its chromosomes into the same directory
+                        results[idx] = parts[idx][0]
+                    else:
+                        sample_depth = {chr_name: depth for part in parts[idx] for chr_name, depth in part.items()}
+                        results[idx] = {chr_name: sample_depth[chr_name] for chr_name, chr_len in chr_len_list}
+
+    if cache_dir is not None:
+        for idx in todo:
+            if results[idx] is not None:
+                commit_depth_cache(sample_raw_dirs[idx], cache_fields[sample_raw_dirs[idx]])
+        # The same BAM listed twice is computed once
+        for idx, filename in enumerate(filenames):
+            if results[idx] is None and depth_cache_hit(sample_raw_dirs[idx]):
+                results[idx] = os.path.join(sample_raw_dirs[idx], os.path.basename(filename).replace('.bam', ''))
+        message = f"Depth cache: {len(filenames) - len(todo)} hits, {len(todo)} misses"
+        if cache_max_mb > 0:
+            n_evicted, freed, cache_bytes = evict_depth_cache(cache_dir, cache_max_mb * 1e6, keep=set(sample_raw_dirs))
+            message += f", evicted {n_evicted} entries ({freed / 1e6:.1f}MB)"
+        log_message(log_filename, message)
+        if cache_max_mb > 0 and cache_bytes > cache_max_mb * 1e6:
+            # Only entries of this run are left, and they alone are over the limit
+            log_message(log_filename, f"WARNING: the depth cache holds {cache_bytes / 1e6:.1f}MB of entries used by "
+                                      f"this run, over depth_cache_max_mb ({cache_max_mb:.0f}MB)")
+
+    sample_files = []
+    sample_depths = []
+    for filename, result in zip(filenames, results):
+        if result is not None:
+            sample_files.append(filename)
+            # Depths written to a directory are opened memory-mapped
+            sample_depths.append(load_from_npy(result) if isinstance(result, str) else result)
+    return sample_files, sample_depths
 
 
-def main():
+def main(args):
     # .config file
     config_file = args.config
     paths = read_config(config_file)
 
+    # Merge baseline stores built on different nodes
+    if args.merge_baseline:
+        meta = merge_baseline_stores(args.merge_baseline, paths['baseline_save_path'],
+                                     dtype=np.dtype(paths.get('baseline_dtype', 'float32')))
+        print(f"Merged {len(args.merge_baseline)} baseline stores: {meta['n_samples']} samples.")
+        return
+
+    # Chromosomes are read, standardized and summed independently, so a sharded job only has to gather
+    # the baseline stores and per-position means of its chromosome shards
+    if args.merge_shards:
+        shards = [shard_name((i, args.merge_shards)) for i in range(args.merge_shards)]
+        bin_len_list = bin_chr_len_list(read_chr_len_file(paths['chr_len_path']), int(paths.get('bin_size', 1)))
+        merge_rj_means(shards, bin_len_list)
+        meta = merge_baseline_shards([os.path.join(paths['baseline_save_path'], shard) for shard in shards],
+                                     paths['baseline_save_path'], bin_len_list)
+        print(f"Merged {args.merge_shards} shards: {len(meta['chr_len'])} chromosomes, {meta['n_samples']} samples.")
+        return
+
     # Input tested files
     test_file_list = paths['test_file_list']
     test_df = pd.read_csv(test_file_list, index_col=0)
@@ -88,6 +371,18 @@ def main():
     baseline_file_list = paths['baseline_file_list']
     bl_df = pd.read_csv(baseline_file_list, index_col=0)
 
+    # An update only adds new samples, and -sumsq cannot be added to a store kept without sums of squares;
+    # stop before reading any BAM or overwriting data/nor
+    if args.update_baseline:
+        meta = load_baseline_meta(paths['baseline_save_path'])
+        if meta is not None:
+            if args.sumsq and not meta['sumsq']:
+                raise ValueError('The baseline store has no sums of squares; '
+                                 'rebuild it with -sumsq instead of updating it')
+            duplicates = set(meta['samples']) & {os.path.basename(sample) for sample in bl_df['file_name']}
+            if duplicates:
+                raise ValueError(f'Samples already in the baseline store: {sorted(duplicates)}')
+
     # Train (if exists)
     try:
         train_file_list = paths['train_file_list']
@@ -111,40 +406,115 @@ def main():
     # Chromosome bed file
     chr_len_path = paths['chr_len_path']
     chr_len_list = read_chr_len_file(chr_len_path)
-    read_len = int(paths['read_len'])
-
-    # Logs
-    log_filename = "log/data_processing_log.txt"
-    os.makedirs(os.path.dirname(log_filename), exist_ok=True)
 
-    # Standardization
-    all_sample_depths = get_std_dep(all_data, chr_len_list, read_len, log_filename)
-    all_standardized_depths_list = standardize_depth(all_sample_depths, chr_len_list)
+    # Every N-th sample or chromosome of the job
+    shard = args.shard
+    if shard and args.shard_by == 'sample':
+        all_data = all_data.iloc[shard[0]::shard[1]].reset_index(drop=True)
+        all_data['mapping'] = ['sample_' + str(i) for i in range(len(all_data))]
+    elif shard:
+        chr_len_list = chr_len_list[shard[0]::shard[1]]
+    read_len = int(paths['read_len'])
 
-    # Save
-    print('save to file ...')
+    # Storage type of the standardized depth files
+    nor_dtype = np.dtype(paths.get('nor_dtype', 'float32'))
 
-    # Create output directory if it doesn't exist
-    json_dir = 'data/nor/'
+    # 'rle' keeps depths as runs of equal values (RunLengthDepth) instead of per-base arrays
+    sparse = paths.get('depth_format', 'dense') == 'rle'
 
-    if not os.path.exists(json_dir):
-        os.makedirs(json_dir)
+    # BAM reading: htslib threads per BAM, and reads skipped by MAPQ or SAM flags
+    bam_options = {'threads': args.bam_threads, 'min_mapq': int(paths.get('min_mapq', 0)),
+                   'exclude_flags': int(paths.get('exclude_flags', '0'), 0)}
 
-    for i in trange(all_data.shape[0]):
-        # Mapping
-        mapping = f"sample_{i}"
-        sample = all_data.loc[all_data['mapping'] == mapping]['file_name'].values[0]
+    # Depths are mean depths of bin_size bases; from here on chromosome lengths are counted in bins
+    bin_size = int(paths.get('bin_size', 1))
+    bin_len_list = bin_chr_len_list(chr_len_list, bin_size)
 
-        filename_part = os.path.basename(sample).replace('.bam', '.json')
+    # Logs
+    log_filename = "log/data_processing_log.txt"
+    os.makedirs(os.path.dirname(log_filename), exist_ok=True)
 
-        new_filename = os.path.join(json_dir, filename_part)
+    # Create output directory if it doesn't exist
+    nor_dir = 'data/nor/'
+
+    if not os.path.exists(nor_dir):
+        os.makedirs(nor_dir)
+
+    # Raw depths are kept on disk when standardizing in blocks
+    raw_dir = 'data/raw/' if args.block_size > 0 else None
+
+    # Raw depths of BAMs processed in earlier runs with the same settings are reused from the depth cache
+    cache_dir = paths.get('depth_cache_path') or None
+    cache_max_mb = float(paths.get('depth_cache_max_mb', 0))
+
+    # Shards running at the same time keep their files apart, and none evicts cache entries another may be reading
+    checkpoint_dir = args.checkpoint
+    if shard:
+        cache_max_mb = 0
+        raw_dir = raw_dir and os.path.join(raw_dir, shard_name(shard))
+        checkpoint_dir = checkpoint_dir and os.path.join(checkpoint_dir, shard_name(shard))
+
+    # Units recorded by a stopped run with the same settings are skipped; raw depths then go to disk
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint = Checkpoint(checkpoint_dir, {'script': 'data_processing.py', 'config': paths,
+                                                 'block_size': args.block_size, 'sumsq': args.sumsq,
+                                                 'update_baseline': args.update_baseline,
+                                                 'shard': args.shard and [args.shard_by, *args.shard]})
+        raw_dir = raw_dir or os.path.join(checkpoint_dir, 'raw')
+
+    # A sample shard only fills the depth cache; the run without -shard then reads every sample from it
+    if shard and args.shard_by == 'sample':
+        if cache_dir is None:
+            raise ValueError('-shard_by sample needs a depth_cache_path in the .config file')
+        sample_files, all_sample_depths = get_std_dep(all_data, chr_len_list, read_len, log_filename,
+                                                      workers=args.workers, sparse=sparse, bin_size=bin_size,
+                                                      bam_options=bam_options, cache_dir=cache_dir,
+                                                      checkpoint=checkpoint)
+        print(f'Shard {shard_name(shard)}: depths of {len(sample_files)} samples in {cache_dir}')
+        return
 
-        standardized_depths = all_standardized_depths_list[i]
-        save2json(standardized_depths, new_filename)
+    # Standardization
+    sample_files, all_sample_depths = get_std_dep(all_data, chr_len_list, read_len, log_filename,
+                                                  workers=args.workers, raw_dir=raw_dir, sparse=sparse,
+                                                  bin_size=bin_size, bam_options=bam_options,
+                                                  cache_dir=cache_dir, cache_max_mb=cache_max_mb,
+                                                  checkpoint=checkpoint)
+
+    # One directory of per-chromosome files per sample
+    sample_dirs = [os.path.join(nor_dir, os.path.basename(sample).replace('.bam', '')) for sample in sample_files]
+
+    # The standardized depths of the same cohort are only written once; a BAM replaced in place makes a new cohort
+    cohort = sample_checkpoint_key(input_identity(sample_files))
+    restored = checkpoint is not None and checkpoint.done(cohort, 'standardize', 'all')
+    # The per-position means of a shard are written apart and gathered by -merge_shards
+    rj_name = f'rj_means_and_n_{shard_name(shard)}' if shard else 'rj_means_and_n'
+    if restored:
+        print('Standardized depths restored from the checkpoint.')
+    elif args.block_size > 0:
+        standardize_depth_blocked(all_sample_depths, bin_len_list, sample_dirs, args.block_size, save_dir=rj_name,
+                                  dtype=nor_dtype)
+    else:
+        if sparse:
+            all_standardized_depths_list = standardize_depth_sparse(all_sample_depths, bin_len_list, save_dir=rj_name)
+        else:
+            all_standardized_depths_list = standardize_depth(all_sample_depths, bin_len_list, save_dir=rj_name)
+
+        # Save
+        print('save to file ...')
+        for i in trange(len(sample_dirs)):
+            with profiler.stage('nor_write', sample=os.path.basename(sample_files[i])):
+                save2npy(all_standardized_depths_list[i], sample_dirs[i], dtype=nor_dtype)
+    if checkpoint is not None and not restored:
+        checkpoint.complete(cohort, 'standardize', 'all', [depth_file_path(sample_dir, chr_name)
+                                                           for sample_dir in sample_dirs
+                                                           for chr_name, chr_len in bin_len_list])
 
     # Set a baseline for comparison
-    # Baseline save path
+    # Baseline save path; a chromosome shard writes a partial store of its chromosomes below it
     baseline_save_path = paths['baseline_save_path']
+    if shard:
+        baseline_save_path = os.path.join(baseline_save_path, shard_name(shard))
 
     if not os.path.exists(baseline_save_path):
         os.makedirs(baseline_save_path)
@@ -155,41 +525,69 @@ def main():
     if bl_df.shape[0] < 50:
         print('WARNING: Please input at least 50 samples as a baseline.')
 
-    cb_data = {}
-    for chr_name, chr_len in chr_len_list:
-        cb_data[chr_name] = np.zeros(chr_len)
+    bl_names = []
+    bl_depths = []
     for i in trange(bl_df.shape[0]):
         mapping = f"sample_{i}"
         sample = bl_df.loc[bl_df['mapping'] == mapping]['file_name'].values[0]
-        filename_part_ = os.path.basename(sample).replace('.bam', '.json')
-        filename = os.path.join(json_dir, filename_part_)
-        print(f'Process {filename} ..................')
-        if os.path.isfile(filename):
-            try:
-                sample_depth = load_from_json(filename)
-                for chr_name, chr_len in chr_len_list:
-                    cb_data[chr_name] = cb_data[chr_name] + sample_depth[chr_name]
-            except Exception as e:
-                current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-                error_message = f"{current_time}:Error occurred while reading {filename}: {e}"
-                print(error_message)
-                # Write the error message to the log file
-                with open(log_filename, "a") as log_file:
-                    log_file.write(error_message + "\n")
-                continue
-
-    # Save to file
-    for chr_name in cb_data:
-        cb_data[chr_name] /= bl_df.shape[0]
-        np.savez(f'{baseline_save_path}/baseline_file_{chr_name}', **cb_data)
-
-    if bl_df.shape[0] < 50:
+        print(f'Process {sample} ..................')
+        try:
+            with profiler.stage('baseline_load', sample=os.path.basename(sample)):
+                # Only the chromosomes of this run: other shards may still be writing theirs
+                sample_depth = load_std_depth(nor_dir, sample, dtype=nor_dtype,
+                                              chr_names={chr_name for chr_name, chr_len in bin_len_list})
+            for chr_name, chr_len in bin_len_list:
+                if chr_name not in sample_depth:
+                    raise KeyError(f'{chr_name} is missing')
+            bl_names.append(os.path.basename(sample))
+            bl_depths.append(sample_depth)
+        except Exception as e:
+            log_error(log_filename, sample, e)
+            continue
+
+    # Save running sums, so samples can be added or stores merged later.
+    # A baseline built from the restored standardized depths is not built (or updated) again.
+    baseline_key = sample_checkpoint_key(sorted(bl_names))
+    bl_files = [depth_file_path(os.path.join(nor_dir, name.replace('.bam', '')), chr_name)
+                for name in bl_names for chr_name, chr_len in bin_len_list]
+    if restored and checkpoint.done(baseline_key, 'baseline', 'all', bl_files):
+        print('Baseline store restored from the checkpoint.')
+        meta = load_baseline_meta(baseline_save_path)
+    else:
+        st = time.time()
+        with profiler.stage('baseline_build'):
+            meta = build_baseline_store(baseline_save_path, bin_len_list, bl_names, bl_depths, sumsq=args.sumsq,
+                                        update=args.update_baseline,
+                                        dtype=np.dtype(paths.get('baseline_dtype', 'float32')), bin_size=bin_size)
+        write_sec = time.time() - st
+        write_mb = sum(os.path.getsize(os.path.join(baseline_save_path, name))
+                       for name in os.listdir(baseline_save_path) if name.endswith('.npy')) / 1e6
+        log_message(log_filename, f"Baseline I/O: wrote {write_mb:.1f}MB for {meta['n_samples']} samples "
+                                  f"in {write_sec:.2f}sec")
+        if checkpoint is not None:
+            store_files = [os.path.join(baseline_save_path, name) for name in sorted(os.listdir(baseline_save_path))
+                           if name.endswith('.npy') or name == 'baseline_store.json']
+            checkpoint.complete(baseline_key, 'baseline', 'all', store_files, inputs=bl_files)
+    if checkpoint is not None:
+        log_message(log_filename, f"Checkpoint: {checkpoint.n_resumed} units restored from {checkpoint.manifest_file}")
+
+    if meta['n_samples'] < 50:
         print('WARNING: Please input at least 50 samples as a baseline.')
 
 
 if __name__ == '__main__':
     st = time.time()
-    main()
+    args = parse_args()
+    # Stage timings, peak RSS, bytes and reads/sec are written next to the log; shards started together each
+    # write their own report
+    report_prefix = f"log/data_processing_profile_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    if args.shard:
+        report_prefix += f'_{shard_name(args.shard)}'
+    if args.profile:
+        run_with_cprofile(lambda: main(args), report_prefix + '.prof')
+    else:
+        main(args)
+    profiler.write_report(report_prefix, script='data_processing.py', config=args.config, workers=args.workers)
     et = time.time()
     rt = et - st
     print(f"Data process finish! runtime: {rt}sec")
@@ -0,0 +1,189 @@
+import os
+import csv
+import numpy as np
+import pandas as pd
+from utils import *
+from data_processing import get_std_dep, standardize_depth, standardize_depth_sparse
+from zip_caller import CNV_COLUMNS, call_cnv, call_cnv_stream, call_cnv_batch, check_chr_len, bin_windows, stack_rows
+
+
+class ZipCnvPipeline:
+    # data_processing.py and zip_caller.py in one process. Standardized depths and the baseline are handed from
+    # one step to the next as arrays, cast to nor_dtype and baseline_dtype as their files would be, so the calls
+    # equal those of the two scripts. data/nor, rj_means_and_n and the baseline store are only written when
+    # nor_dir and baseline_save_path are set.
+    #
+    #   pipeline = ZipCnvPipeline.from_config('my.config', slide_wins=[3000])
+    #   calls = pipeline.run(test_bams, baseline_bams, output_file='data/zipcall-output/calls.cnv')
+
+    def __init__(self, chr_len_list, read_len, bin_size=1, depth_format='dense', min_mapq=0, exclude_flags=0,
+                 bam_threads=1, workers=1, nor_dtype='float32', baseline_dtype='float32', slide_wins=(3000,), K=0.3,
+                 batch=0, chunk_size=0, cache_dir=None, cache_max_mb=0, nor_dir=None, baseline_save_path=None,
+                 log_dir='log'):
+        if batch > 0 and chunk_size > 0:
+            raise ValueError('batch and chunk_size cannot be combined')
+        self.chr_len_list = chr_len_list
+        self.read_len = read_len
+        # Depths are mean depths of bin_size bases; standardization, baseline and calling count in bins
+        self.bin_size = bin_size
+        self.bin_len_list = bin_chr_len_list(chr_len_list, bin_size)
+        self.sparse = depth_format == 'rle'
+        self.bam_options = {'threads': bam_threads, 'min_mapq': min_mapq, 'exclude_flags': exclude_flags}
+        self.workers = workers
+        self.nor_dtype = np.dtype(nor_dtype)
+        self.baseline_dtype = np.dtype(baseline_dtype)
+        self.slide_wins = sorted(set(slide_wins))
+        self.K = K
+        self.batch = batch
+        self.chunk_size = chunk_size
+        self.cache_dir = cache_dir
+        self.cache_max_mb = cache_max_mb
+        self.nor_dir = nor_dir
+        self.baseline_save_path = baseline_save_path
+        self.log_filename = os.path.join(log_dir, 'pipeline_log.txt')
+        os.makedirs(log_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config_file, persist=False, **kwargs):
+        # The settings of a .config file, overridden by kwargs.
+        # With persist, intermediates are written where data_processing.py writes them.
+        paths = read_config(config_file)
+        settings = {'chr_len_list': read_chr_len_file(paths['chr_len_path']), 'read_len': int(paths['read_len']),
+                    'bin_size': int(paths.get('bin_size', 1)), 'depth_format': paths.get('depth_format', 'dense'),
+                    'min_mapq': int(paths.get('min_mapq', 0)), 'exclude_flags': int(paths.get('exclude_flags', '0'), 0),
+                    'nor_dtype': paths.get('nor_dtype', 'float32'),
+                    'baseline_dtype': paths.get('baseline_dtype', 'float32'),
+                    'cache_dir': paths.get('depth_cache_path') or None,
+                    'cache_max_mb': float(paths.get('depth_cache_max_mb', 0))}
+        if persist:
+            settings.update(nor_dir='data/nor/', baseline_save_path=paths['baseline_save_path'])
+        settings.update(kwargs)
+        return cls(**settings)
+
+    def standardize(self, bam_files):
+        # Standardized depths of one cohort, as data_processing.py computes them.
+        # Returns the BAMs that could be read and their depths ({chr_name: array or RunLengthDepth}).
+        df = pd.DataFrame({'file_name': list(bam_files), 'mapping': [f'sample_{i}' for i in range(len(bam_files))]})
+        sample_files, sample_depths = get_std_dep(df, self.chr_len_list, self.read_len, self.log_filename,
+                                                  workers=self.workers, sparse=self.sparse, bin_size=self.bin_size,
+                                                  bam_options=self.bam_options, cache_dir=self.cache_dir,
+                                                  cache_max_mb=self.cache_max_mb)
+        persist = self.nor_dir is not None
+        if self.sparse:
+            standardized = standardize_depth_sparse(sample_depths, self.bin_len_list,
+                                                    save_dir='rj_means_and_n' if persist else None)
+        else:
+            standardized = standardize_depth(sample_depths, self.bin_len_list,
+                                             save_dir='rj_means_and_n' if persist else None)
+        del sample_depths
+
+        std_depths = []
+        for i, filename in enumerate(sample_files):
+            if persist:
+                with profiler.stage('nor_write', sample=os.path.basename(filename)):
+                    sample_dir = os.path.join(self.nor_dir, os.path.basename(filename).replace('.bam', ''))
+                    save2npy(standardized[i], sample_dir, dtype=self.nor_dtype)
+            # The values the .npy / .rle.npz files would hold
+            std_depths.append({chr_name: depth.astype(self.nor_dtype) if isinstance(depth, RunLengthDepth)
+                               else np.asarray(depth, dtype=self.nor_dtype)
+                               for chr_name, depth in standardized.pop(i).items()})
+        return sample_files, std_depths
+
+    def build_baseline(self, sample_names, std_depths):
+        # The baseline of these standardized depths, {chr_name: baseline_dtype array}.
+        # With baseline_save_path, the baseline store is written and its baseline files are memory-mapped.
+        if len(sample_names) < 50:
+            print('WARNING: Please input at least 50 samples as a baseline.')
+        with profiler.stage('baseline_build'):
+            if self.baseline_save_path is None:
+                return calcu_baseline(self.bin_len_list, std_depths, dtype=self.baseline_dtype)
+            build_baseline_store(self.baseline_save_path, self.bin_len_list, sample_names, std_depths,
+                                 dtype=self.baseline_dtype, bin_size=self.bin_size)
+            return open_baseline(self.baseline_save_path, self.bin_len_list, dtype=self.baseline_dtype)
+
+    def call(self, samples, std_depths, baseline):
+        # Calls of every sample as zip_caller.py writes them (CNV_COLUMNS). As there, an error is logged and the
+        # rest of that sample is skipped.
+        results = []
+        if self.batch > 0:
+            for i in range(0, len(samples), self.batch):
+                results += self.call_batch(samples[i:i + self.batch], std_depths[i:i + self.batch], baseline)
+            return results
+        for sample, sample_depth in zip(samples, std_depths):
+            try:
+                for chr_name, chr_len in self.bin_len_list:
+                    if self.chunk_size > 0:
+                        results += call_cnv_stream(sample_depth[chr_name], baseline[chr_name], chr_name, sample,
+                                                   self.slide_wins, self.K, self.bin_size, self.chunk_size)
+                    else:
+                        results += call_cnv(sample_depth[chr_name], np.asarray(baseline[chr_name], dtype=np.float64),
+                                            chr_name, sample, self.slide_wins, self.K, self.bin_size)
+            except Exception as e:
+                log_error(self.log_filename, sample, e)
+        return results
+
+    def call_batch(self, samples, std_depths, baseline):
+        # call for one batch of samples, one samples x positions matrix per chromosome
+        batch_results = [[] for _ in samples]
+        failed = set()
+        for chr_name, chr_len in self.bin_len_list:
+            b = np.asarray(baseline[chr_name], dtype=np.float64)
+            stacked = []
+            for idx, sample_depth in enumerate(std_depths):
+                if idx in failed:
+                    continue
+                try:
+                    check_chr_len(sample_depth[chr_name], b, chr_name, self.bin_size)
+                    stacked.append(idx)
+                except Exception as e:
+                    failed.add(idx)
+                    log_error(self.log_filename, samples[idx], e)
+            if not stacked:
+                continue
+            try:
+                b_index = calcu_win_index(b, max(bin_windows(self.slide_wins, self.bin_size).values()))
+                rows = stack_rows([std_depths[idx][chr_name] for idx in stacked], len(b))
+                chr_results = call_cnv_batch(rows, b, chr_name, [samples[idx] for idx in stacked],
+                                             self.slide_wins, self.K, self.bin_size, b_index)
+                del rows
+            except Exception as e:
+                for idx in stacked:
+                    failed.add(idx)
+                    log_error(self.log_filename, samples[idx], e)
+                continue
+            for idx, sample_results in zip(stacked, chr_results):
+                batch_results[idx] += sample_results
+        return [result for sample_results in batch_results for result in sample_results]
+
+    def run(self, test_files, baseline_files, train_files=(), output_file=None):
+        # Test, baseline and train BAMs are standardized together, the baseline is built from the baseline BAMs
+        # and the test BAMs are called. Returns the calls, also written to output_file when given.
+        sample_files, std_depths = self.standardize(list(test_files) + list(baseline_files) + list(train_files))
+        depths = {os.path.basename(filename): depth for filename, depth in zip(sample_files, std_depths)}
+        del std_depths
+
+        bl_names = []
+        bl_depths = []
+        for filename in baseline_files:
+            sample = os.path.basename(filename)
+            try:
+                if sample not in depths:
+                    raise FileNotFoundError(f'No standardized depth for {filename}')
+                for chr_name, chr_len in self.bin_len_list:
+                    if chr_name not in depths[sample]:
+                        raise KeyError(f'{chr_name} is missing')
+                bl_names.append(sample)
+                bl_depths.append(depths[sample])
+            except Exception as e:
+                log_error(self.log_filename, sample, e)
+        baseline = self.build_baseline(bl_names, bl_depths)
+
+        samples = [os.path.basename(filename) for filename in test_files if os.path.basename(filename) in depths]
+        results = self.call(samples, [depths[sample] for sample in samples], baseline)
+        if output_file is not None:
+            os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+            with open(output_file, 'w', newline='') as file:
+                csv_writer = csv.writer(file, delimiter='\t')
+                csv_writer.writerow(CNV_COLUMNS)
+                csv_writer.writerows(results)
+        return results
@@ -7,4 +7,4 @@
 #SBATCH --error=%j.err               # Standard error will go to jobID.err
 
 #  Python ű
-python3 data_processing.py -config my.config
+python3 data_processing.py -config my.config -workers 28
@@ -0,0 +1,19 @@
+#!/bin/bash
+# Submit data_processing.py and zip_caller.py as N-task SLURM arrays, each followed by its merge step.
+# Jobs only share the filesystem; the merged outputs are identical to a single-node run.
+N=${N:-8}
+CONFIG=${CONFIG:-my.config}
+OUT=${OUT:-data/zipcall-output}
+
+# Depths, standardization and partial baseline stores, every N-th chromosome per task
+dp=$(sbatch --parsable --array=0-$((N - 1)) -N 1 -n 28 --partition=normal4 --output=%A_%a.out --error=%A_%a.err \
+    --wrap "python3 data_processing.py -config $CONFIG -workers 28 -shard \$SLURM_ARRAY_TASK_ID/$N")
+dp_merge=$(sbatch --parsable --dependency=afterok:$dp -N 1 -n 1 --partition=normal4 --output=%j.out --error=%j.err \
+    --wrap "python3 data_processing.py -config $CONFIG -merge_shards $N")
+
+# Calls, every N-th test sample per task
+zc=$(sbatch --parsable --dependency=afterok:$dp_merge --array=0-$((N - 1)) -N 1 -n 28 --partition=normal1 \
+    --output=%A_%a.out --error=%A_%a.err \
+    --wrap "python3 zip_caller.py -config $CONFIG -o $OUT -workers 28 -shard \$SLURM_ARRAY_TASK_ID/$N")
+sbatch --dependency=afterok:$zc -N 1 -n 1 --partition=normal1 --output=%j.out --error=%j.err \
+    --wrap "python3 zip_caller.py -config $CONFIG -o $OUT -merge $OUT/zipcaller_res_shard_*_of_$N.cnv"
@@ -7,7 +7,7 @@
 #SBATCH --error=%j.err               # Standard error will go to jobID.err
 
 #  Python ű
-python3 zip_caller.py -config my.config -o data/zipcall-output
+python3 zip_caller.py -config my.config -o data/zipcall-output -workers 28
 
 
 
@@ -1,6 +1,26 @@
+import os
+import time
+from datetime import datetime
 import numpy as np
 import json
+import csv
+import shutil
+import hashlib
+import cProfile
+import pstats
+from contextlib import contextmanager
 import pysam
+from array import array
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 def read_fasta_file(filename):
     sequences = {}
@@ -103,23 +123,1009 @@ def read_chr_len_file(file_path):
     return result
 
 
-def calcu_bam_dep(chr_len_list, filename, read_len):
+def has_bam_index(filename):
+    with pysam.AlignmentFile(filename, "r") as file:
+        return file.has_index()
+
+
+def read_bam_starts(filename, chr_len_list, threads=1, min_mapq=0, exclude_flags=0):
+    # Keep only the 0-based start of each read, per chromosome.
+    # With an index only the chromosomes in chr_len_list are fetched, otherwise the whole file is streamed.
+    # Reads with any of exclude_flags set (e.g. 0x400 duplicate, 0x100 secondary) or MAPQ < min_mapq are skipped.
+    # threads are htslib decompression threads.
+    read_starts = {}
+    for chro in chr_len_list:
+        read_starts[chro[0]] = array('q')
+
+    with profiler.stage('bam_parse', sample=os.path.basename(filename), chromosome=chr_label(chr_len_list)) as record, \
+            pysam.AlignmentFile(filename, "r", threads=threads) as file:
+        if file.has_index():
+            references = set(file.references)
+            for chro_name, starts in read_starts.items():
+                if chro_name not in references:
+                    continue
+                for read in file.fetch(chro_name):
+                    if read.flag & exclude_flags or read.mapping_quality < min_mapq:
+                        continue
+                    starts.append(read.reference_start)
+        else:
+            tid_starts = [read_starts.get(name) for name in file.references]
+            for read in file:
+                tid = read.reference_id
+                if tid < 0 or tid_starts[tid] is None or read.flag & exclude_flags or read.mapping_quality < min_mapq:
+                    continue
+                tid_starts[tid].append(read.reference_start)
+        record['reads'] = sum(len(starts) for starts in read_starts.values())
+
+    return {chro_name: np.frombuffer(starts, dtype=np.int64) for chro_name, starts in read_starts.items()}
+
+
+def calcu_chr_dep(read_starts, chro_len, read_len):
+    # Difference array: +1 at each read start, -1 one past its end, then a cumulative sum.
+    # Depths are int32, half the bytes of float64 when pool workers send them back; standardization casts them.
+    read_starts = read_starts[read_starts < chro_len]
+    read_ends = np.minimum(read_starts + read_len, chro_len)
+    diff = np.zeros(chro_len + 1, dtype=np.int32)
+    np.add.at(diff, read_starts, 1)
+    np.add.at(diff, read_ends, -1)
+    return np.cumsum(diff[:chro_len], dtype=np.int32)
+
+
+def calcu_chr_bin_dep(read_starts, chro_len, read_len, bin_size):
+    # Mean depth of every bin_size bases (the last bin may be shorter), from the read starts and ends only.
+    # Bases covered before position e: sum over reads of (e - start)+ - (e - end)+
+    read_starts = np.sort(read_starts[read_starts < chro_len])
+    read_ends = np.sort(np.minimum(read_starts + read_len, chro_len))
+    edges = np.append(np.arange(0, chro_len, bin_size), chro_len)
+
+    def covered_before(positions):
+        count = np.searchsorted(positions, edges, side='left')
+        prefix = np.concatenate(([0], np.cumsum(positions)))
+        return count * edges - prefix[count]
+
+    coverage = covered_before(read_starts) - covered_before(read_ends)
+    return np.diff(coverage) / np.diff(edges)
+
+
+def bin_chr_len_list(chr_len_list, bin_size):
+    # Number of bins of each chromosome
+    return [[chr_name, -(-chr_len // bin_size)] for chr_name, chr_len in chr_len_list]
+
+
+class RunLengthDepth:
+    # Per-base values of one chromosome stored as runs: values[k] covers [starts[k], starts[k + 1]),
+    # the last run ends at length. Memory grows with the number of runs, not the chromosome length.
+    # Slices and elementwise operations stay run-length encoded; np.asarray() gives the dense array.
+
+    def __init__(self, starts, values, length):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.values = np.asarray(values)
+        self.length = int(length)
+
+    @classmethod
+    def from_dense(cls, dense):
+        dense = np.asarray(dense)
+        starts = np.concatenate(([0], np.flatnonzero(dense[1:] != dense[:-1]) + 1)) if len(dense) else []
+        return cls(starts, dense[starts], len(dense))
+
+    @classmethod
+    def from_read_starts(cls, read_starts, chro_len, read_len):
+        # Depth as calcu_chr_dep computes it, from the read start and end breakpoints only
+        read_starts = read_starts[read_starts < chro_len]
+        read_ends = np.minimum(read_starts + read_len, chro_len)
+        pos, inverse = np.unique(np.concatenate(([0], read_starts, read_ends)), return_inverse=True)
+        delta = np.concatenate(([0], np.ones(len(read_starts)), -np.ones(len(read_ends))))
+        depth = np.cumsum(np.bincount(inverse, weights=delta)).astype(np.int64)
+        keep = pos < chro_len
+        return cls(pos[keep], depth[keep], chro_len).compress()
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            return cls(data['starts'], data['values'], int(data['length']))
+
+    def save(self, file_name, dtype=None):
+        starts_dtype = np.int32 if self.length < 2 ** 31 else np.int64
+        values = self.values if dtype is None else self.values.astype(dtype)
+        np.savez(file_name, starts=self.starts.astype(starts_dtype), values=values, length=self.length)
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.values.nbytes
+
+    def run_lengths(self):
+        return np.diff(np.append(self.starts, self.length))
+
+    def astype(self, dtype):
+        return RunLengthDepth(self.starts, self.values.astype(dtype), self.length)
+
+    def to_dense(self, dtype=None):
+        values = self.values if dtype is None else self.values.astype(dtype)
+        return np.repeat(values, self.run_lengths())
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype)
+
+    def compress(self):
+        # Merge neighbouring runs with equal values
+        if len(self.values) < 2:
+            return self
+        keep = np.concatenate(([True], self.values[1:] != self.values[:-1]))
+        return RunLengthDepth(self.starts[keep], self.values[keep], self.length)
+
+    def _values_at(self, pos):
+        return self.values[np.searchsorted(self.starts, pos, side='right') - 1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            pos = int(key) + self.length if int(key) < 0 else int(key)
+            if not 0 <= pos < self.length:
+                raise IndexError(f'index {key} is out of bounds for length {self.length}')
+            return self._values_at(pos)
+        start, stop, step = key.indices(self.length)
+        if step != 1:
+            raise ValueError('Only contiguous slices of a RunLengthDepth are supported')
+        if stop <= start:
+            return RunLengthDepth([], self.values[:0], 0)
+        first = np.searchsorted(self.starts, start, side='right') - 1
+        last = np.searchsorted(self.starts, stop, side='left')
+        starts = self.starts[first:last] - start
+        starts[0] = 0
+        return RunLengthDepth(starts, self.values[first:last], stop - start)
+
+    def _binary(self, other, op):
+        if isinstance(other, RunLengthDepth):
+            if other.length != self.length:
+                raise ValueError(f'Lengths differ: {self.length} and {other.length}')
+            starts = np.union1d(self.starts, other.starts)
+            return RunLengthDepth(starts, op(self._values_at(starts), other._values_at(starts)), self.length).compress()
+        return RunLengthDepth(self.starts, op(self.values, other), self.length).compress()
+
+    def __add__(self, other):
+        return self._binary(other, np.add)
+
+    def __radd__(self, other):
+        return self._binary(other, lambda a, b: np.add(b, a))
+
+    def __sub__(self, other):
+        return self._binary(other, np.subtract)
+
+    def __mul__(self, other):
+        return self._binary(other, np.multiply)
+
+    def __truediv__(self, other):
+        return self._binary(other, np.true_divide)
+
+    def round(self, decimals=0, out=None):
+        return RunLengthDepth(self.starts, np.round(self.values, decimals), self.length).compress()
+
+    def median(self):
+        # Same value as np.median of the dense array
+        order = np.argsort(self.values, kind='stable')
+        values = self.values[order].astype(np.float64)
+        cum_lengths = np.cumsum(self.run_lengths()[order])
+        lower = values[np.searchsorted(cum_lengths, (self.length - 1) // 2, side='right')]
+        upper = values[np.searchsorted(cum_lengths, self.length // 2, side='right')]
+        return (lower + upper) / 2
+
+    def win_sum(self, window_size, chunk_size=1 << 20):
+        # Sum of every window of window_size values, evaluated from the run breakpoints. Between two window
+        # starts where the first or the last value of the window changes run, each step adds the value of the
+        # last run and drops that of the first, so the sum is linear in the position. Apart from the output,
+        # only chunk_size positions are per-base at a time. All-zero windows are exactly 0.
+        n_win = self.length - window_size + 1
+        if n_win <= 0:
+            return np.zeros(0)
+        values = self.values.astype(np.float64)
+        prefix = np.concatenate(([0.0], np.cumsum(values * self.run_lengths())))
+
+        def prefix_at(pos):
+            # Sum of the values before each position
+            run = np.searchsorted(self.starts, pos, side='right') - 1
+            return prefix[run] + values[run] * (pos - self.starts[run])
+
+        last_starts = self.starts - window_size + 1
+        seg_starts = np.union1d(self.starts[self.starts < n_win],
+                                last_starts[(last_starts > 0) & (last_starts < n_win)])
+        seg_sum = prefix_at(seg_starts + window_size) - prefix_at(seg_starts)
+        seg_slope = self._values_at(seg_starts + window_size - 1).astype(np.float64) - self._values_at(seg_starts)
+
+        out = np.empty(n_win)
+        for chunk_st in range(0, n_win, chunk_size):
+            chunk_et = min(chunk_st + chunk_size, n_win)
+            first = np.searchsorted(seg_starts, chunk_st, side='right') - 1
+            last = np.searchsorted(seg_starts, chunk_et, side='left')
+            bounds = np.clip(seg_starts[first:last], chunk_st, chunk_et)
+            seg = np.repeat(np.arange(first, last), np.diff(np.append(bounds, chunk_et)))
+            out[chunk_st:chunk_et] = seg_sum[seg] + (np.arange(chunk_st, chunk_et) - seg_starts[seg]) * seg_slope[seg]
+        return out
+
+
+def calcu_bam_dep(chr_len_list, filename, read_len, sparse=False, bin_size=1, threads=1, min_mapq=0,
+                  exclude_flags=0):
 
     sample_depth = {}
+    read_starts = read_bam_starts(filename, chr_len_list, threads, min_mapq, exclude_flags)
     for chro in chr_len_list:
         chro_name = chro[0]
         chro_len = chro[1]
-        sample_depth[chro_name] = np.zeros(chro_len)
-    alignments = read_bam_file(filename)
-    for idx, sam in enumerate(alignments):
-        if sam['RNAME'] != '*':
-            chro_name = sam['RNAME']
-            pos = sam['POS']
-            for j in range(pos - 1, pos + read_len - 1):
-                sample_depth[chro_name][j] += 1
+        with profiler.stage('pileup', sample=os.path.basename(filename), chromosome=chro_name):
+            if bin_size > 1:
+                bin_depth = calcu_chr_bin_dep(read_starts.pop(chro_name), chro_len, read_len, bin_size)
+                sample_depth[chro_name] = RunLengthDepth.from_dense(bin_depth) if sparse else bin_depth
+            elif sparse:
+                sample_depth[chro_name] = RunLengthDepth.from_read_starts(read_starts.pop(chro_name), chro_len,
+                                                                          read_len)
+            else:
+                sample_depth[chro_name] = calcu_chr_dep(read_starts.pop(chro_name), chro_len, read_len)
     return sample_depth
 
 
+def save_bam_dep(chr_len_list, filename, read_len, raw_dir, sparse=False, bin_size=1, threads=1, min_mapq=0,
+                 exclude_flags=0):
+    # Store the read depth of a BAM (int32, float64 bin means) and return its directory
+    out_dir = os.path.join(raw_dir, os.path.basename(filename).replace('.bam', ''))
+    sample_depth = calcu_bam_dep(chr_len_list, filename, read_len, sparse, bin_size, threads, min_mapq, exclude_flags)
+    with profiler.stage('raw_write', sample=os.path.basename(filename), chromosome=chr_label(chr_len_list)):
+        save2npy(sample_depth, out_dir, dtype=np.int32 if bin_size == 1 else np.float64)
+    return out_dir
+
+
+def depth_cache_key(filename, chr_len_list, read_len, sparse=False, bin_size=1, min_mapq=0, exclude_flags=0):
+    # Cache key of a raw depth: the BAM's path, size and mtime and every setting that changes the depth
+    stat = os.stat(filename)
+    fields = {'bam': os.path.abspath(filename), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+              'read_len': read_len, 'chr_len': [list(chro) for chro in chr_len_list], 'sparse': sparse,
+              'bin_size': bin_size, 'min_mapq': min_mapq, 'exclude_flags': exclude_flags}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest(), fields
+
+
+def depth_cache_hit(entry_dir):
+    # An entry is complete once entry.json is written; its mtime records the last use
+    entry_file = os.path.join(entry_dir, 'entry.json')
+    if not os.path.isfile(entry_file):
+        return False
+    os.utime(entry_file)
+    return True
+
+
+def commit_depth_cache(entry_dir, fields):
+    with open(os.path.join(entry_dir, 'entry.json'), 'w') as f:
+        json.dump(fields, f, indent=4)
+
+
+def evict_depth_cache(cache_dir, max_bytes, keep=()):
+    # Delete the least recently used entries until the cache fits in max_bytes; entries in keep are not deleted.
+    # Entries without entry.json were left by runs that stopped while reading a BAM; they count and are deleted
+    # like the others, last used when their files last changed.
+    # Returns the number of deleted entries, their size and the size of the cache afterwards, in bytes
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            continue
+        files = [os.path.join(root, name) for root, dirs, names in os.walk(entry_dir) for name in names]
+        entry_file = os.path.join(entry_dir, 'entry.json')
+        if os.path.isfile(entry_file):
+            last_used = os.path.getmtime(entry_file)
+        else:
+            last_used = max([os.path.getmtime(entry_dir)] + [os.path.getmtime(file) for file in files])
+        entries.append((last_used, sum(os.path.getsize(file) for file in files), entry_dir))
+    total = sum(size for last_used, size, entry_dir in entries)
+    n_evicted = 0
+    freed = 0
+    for last_used, size, entry_dir in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        if entry_dir in keep:
+            continue
+        shutil.rmtree(entry_dir)
+        n_evicted += 1
+        freed += size
+    return n_evicted, freed, total - freed
+
+
+def file_sha256(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def input_identity(files):
+    # Path, size and mtime of the input files of a unit, as depth_cache_key identifies a BAM
+    identity = {}
+    for file_path in files:
+        stat = os.stat(file_path)
+        identity[os.path.abspath(file_path)] = [stat.st_size, stat.st_mtime_ns]
+    return identity
+
+
+class Checkpoint:
+    # Completed (sample, stage, chromosome) units of a run with the sha256, size and mtime of their output files
+    # and the path, size and mtime of their input files, journaled to <checkpoint_dir>/manifest.jsonl one line per
+    # unit. A run restarted with the same settings skips units whose inputs are unchanged and whose outputs are
+    # intact; with other settings the manifest starts over.
+
+    def __init__(self, checkpoint_dir, settings):
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_file = os.path.join(checkpoint_dir, 'manifest.jsonl')
+        # Settings as they read back from JSON
+        settings = json.loads(json.dumps(settings, sort_keys=True))
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.header = None
+        self.units = {}
+        self.n_resumed = 0
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                lines = f.read().splitlines()
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                if self.header is None:
+                    self.header = record
+                else:
+                    self.units[record['unit']] = record
+            if self.header is None or self.header['settings'] != settings:
+                print(f'{self.manifest_file} was written with other settings, starting over')
+                self.header = None
+                self.units = {}
+        if self.header is None:
+            self.header = {'run_id': datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), 'settings': settings}
+            with open(self.manifest_file, 'w') as f:
+                f.write(json.dumps(self.header) + '\n')
+
+    @property
+    def run_id(self):
+        # Time of the first run, so a resumed run writes to the same output files
+        return self.header['run_id']
+
+    @staticmethod
+    def unit_key(sample, stage, chr_name):
+        return f'{sample}|{stage}|{chr_name}'
+
+    def done(self, sample, stage, chr_name, inputs=()):
+        # The unit is recorded from the same inputs and its files are unchanged: same size and mtime, or else the
+        # same sha256
+        record = self.units.get(self.unit_key(sample, stage, chr_name))
+        if record is None or not all(os.path.isfile(file_path) for file_path in inputs):
+            return False
+        if record.get('inputs', {}) != input_identity(inputs):
+            return False
+        for file_path, (digest, size, mtime_ns) in record['files'].items():
+            if not os.path.isfile(file_path):
+                return False
+            stat = os.stat(file_path)
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns) and file_sha256(file_path) != digest:
+                return False
+        self.n_resumed += 1
+        return True
+
+    def complete(self, sample, stage, chr_name, files, inputs=()):
+        # Record a finished unit, its output files and the input files it was made from
+        record = {'unit': self.unit_key(sample, stage, chr_name), 'time': datetime.now().strftime("%Y%m%d_%H%M%S"),
+                  'files': {}, 'inputs': input_identity(inputs)}
+        for file_path in files:
+            stat = os.stat(file_path)
+            record['files'][file_path] = [file_sha256(file_path), stat.st_size, stat.st_mtime_ns]
+        self.units[record['unit']] = record
+        with open(self.manifest_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_rows(self, sample, stage, chr_name, rows, inputs=()):
+        # Store the .cnv rows of a unit as a fragment and record it; merge_rows copies the fragments in order
+        fragment = os.path.join(self.checkpoint_dir, 'parts', sample, f'{stage}_{chr_name}.cnv')
+        os.makedirs(os.path.dirname(fragment), exist_ok=True)
+        with open(fragment, 'w', newline='') as f:
+            csv.writer(f, delimiter='\t').writerows(rows)
+        self.complete(sample, stage, chr_name, [fragment], inputs)
+
+    def merge_rows(self, file, units):
+        # Append the fragments of the completed (sample, stage, chromosome) units to an open file
+        for sample, stage, chr_name in units:
+            record = self.units.get(self.unit_key(sample, stage, chr_name))
+            if record is not None:
+                for file_path in record['files']:
+                    with open(file_path, 'r', newline='') as f:
+                        file.write(f.read())
+
+
+def depth_file_path(input_dir, chr_name):
+    # The file load_depth_file reads
+    rle_file = os.path.join(input_dir, f'{chr_name}.rle.npz')
+    return rle_file if os.path.isfile(rle_file) else os.path.join(input_dir, f'{chr_name}.npy')
+
+
+def calcu_win_sum(data, window_size):
+    # Sum of every window of window_size consecutive values in O(n).
+    # Prefix sums restart every window_size positions, so a window is the tail of one block plus the
+    # head of the next: rounding stays at the scale of one window and all-zero windows are exactly 0.
+    if isinstance(data, RunLengthDepth):
+        return data.win_sum(window_size)
+    return index_win_sum(calcu_win_index(data, window_size), window_size)
+
+
+def calcu_win_index(data, block_size):
+    # Prefix sums restarting every block_size positions, and the sum of every block.
+    # One index answers index_win_sum for every window size up to block_size.
+    # A 2-D data (samples x positions) is indexed row by row.
+    # The index is the only array of data's size: values are shifted one place into it and summed in place.
+    data = np.asarray(data)
+    rows = data.shape[:-1]
+    length = data.shape[-1]
+    n_blocks = -(-length // block_size) + 1
+    head = np.zeros(rows + (n_blocks * block_size,))
+    head[..., 1:length + 1] = data
+    # The last value of each block is left out of its exclusive prefix sums and added to the block sum
+    block_last = np.asarray(data[..., block_size - 1::block_size], dtype=np.float64)
+    head[..., ::block_size] = 0
+    blocks = head.reshape(rows + (n_blocks, block_size))
+    np.cumsum(blocks, axis=-1, out=blocks)
+    block_sum = blocks[..., -1].copy()
+    block_sum[..., :block_last.shape[-1]] += block_last
+    return head, block_sum, length
+
+
+def index_win_sum(index, window_size):
+    # Window sums from calcu_win_index in O(n): a window lies in one block or is the tail of one block
+    # plus the head of the next
+    head, block_sum, length = index
+    block_size = head.shape[-1] // block_sum.shape[-1]
+    if window_size > block_size:
+        raise ValueError(f'Window size {window_size} is larger than the index block size {block_size}')
+    n_win = length - window_size + 1
+    if n_win <= 0:
+        return np.zeros(head.shape[:-1] + (0,))
+    if window_size == block_size:
+        win_sum = np.repeat(block_sum, block_size, axis=-1)[..., :n_win]
+        win_sum -= head[..., :n_win]
+        win_sum += head[..., window_size:window_size + n_win]
+        return win_sum
+    win_sum = head[..., window_size:window_size + n_win] - head[..., :n_win]
+    # Windows starting in the last window_size positions of a block end in the next one
+    cross = np.arange(block_size - window_size, block_size) + np.arange(0, n_win, block_size)[:, None]
+    cross = cross[cross < n_win]
+    win_sum[..., cross] = (block_sum[..., cross // block_size] - head[..., cross]) + head[..., cross + window_size]
+    return win_sum
+
+
+def segmented_accumulate(ufunc, values, seg_starts):
+    # ufunc.accumulate restarted at every index in seg_starts (which must include 0).
+    # Segments are grouped by length (powers of two) and accumulated row-wise, so each
+    # segment is still summed left to right and padding at most doubles the work.
+    out = np.empty_like(values)
+    lengths = np.diff(np.append(seg_starts, len(values)))
+    buckets = np.ceil(np.log2(lengths)).astype(np.int64)
+    for bucket in np.unique(buckets):
+        sel = np.flatnonzero(buckets == bucket)
+        width = lengths[sel].max()
+        if width == 1:
+            out[seg_starts[sel]] = values[seg_starts[sel]]
+            continue
+        idx = seg_starts[sel][:, None] + np.arange(width)
+        mask = np.arange(width) < lengths[sel][:, None]
+        block = np.zeros(idx.shape, dtype=values.dtype)
+        block[mask] = values[idx[mask]]
+        out[idx[mask]] = ufunc.accumulate(block, axis=1)[mask]
+    return out
+
+
+def _cusum_upper_finite(z):
+    # ct[0] = 0, ct[i] = max(0, z[i] + ct[i - 1]) for z without nan or +inf
+    n = len(z)
+    hard_reset = np.isneginf(z)
+    hard_reset[0] = True
+    z_finite = np.where(hard_reset, 0.0, z)
+
+    # Guess the resets from the closed form ct = P - min(0, running min of P)
+    hard_starts = np.flatnonzero(hard_reset)
+    prefix = segmented_accumulate(np.add, z_finite, hard_starts)
+    reset = prefix <= segmented_accumulate(np.minimum, prefix, hard_starts)
+
+    # Sum exactly between resets and check every reset decision against the recursion.
+    # A wrong guess is corrected and the check repeated; the first mismatch only moves forward.
+    while True:
+        reset[0] = True
+        ct = segmented_accumulate(np.add, np.where(reset, 0.0, z_finite), np.flatnonzero(reset))
+        cand = np.empty(n)
+        cand[0] = -np.inf
+        cand[1:] = z[1:] + ct[:-1]
+        true_reset = cand <= 0
+        if np.array_equal(reset, true_reset):
+            return ct
+        reset = true_reset
+
+
+def _cusum_upper(z):
+    ct = np.zeros(len(z))
+    if len(z) < 2:
+        return ct
+    # Past the first nan or +inf the statistic is no longer finite
+    stop = np.isnan(z) | np.isposinf(z)
+    stop[0] = False
+    end = np.argmax(stop) if stop.any() else len(z)
+    ct[:end] = _cusum_upper_finite(z[:end])
+    if end < len(z):
+        tail = z[end:]
+        if np.isposinf(tail[0]):
+            # +inf holds until a nan or -inf turns it into nan
+            poison = np.isnan(tail) | np.isneginf(tail)
+            end_inf = end + (np.argmax(poison) if poison.any() else len(tail))
+            ct[end:end_inf] = np.inf
+            ct[end_inf:] = np.nan
+        else:
+            ct[end:] = np.nan
+    return ct
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _cusum_numba(data, K, prev_up, prev_down, first):
+        # Positions before first are 0; prev_up / prev_down precede position first
+        n = len(data)
+        ct_up = np.zeros(n)
+        ct_down = np.zeros(n)
+        for i in range(first, n):
+            # Same comparisons as np.max / np.min, which propagate nan
+            up = data[i] - K + prev_up
+            ct_up[i] = up if (up > 0 or up != up) else 0.0
+            down = data[i] + K + prev_down
+            ct_down[i] = down if (down < 0 or down != down) else 0.0
+            prev_up = ct_up[i]
+            prev_down = ct_down[i]
+        return ct_up, ct_down
+
+
+def calcu_cusum(data, K, use_numba=True, init=None):
+    # Upper and lower CUSUM of data with reference value K, ct[0] = 0.
+    # With init = (ct_up, ct_down) of the position before data[0], the recursion continues from there
+    # instead, so a long series can be processed in chunks.
+    # Uses a Numba loop when available, otherwise an exact vectorized NumPy version.
+    # A 2-D data (samples x positions) gets one CUSUM per row.
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 2:
+        ct_up = np.empty_like(data)
+        ct_down = np.empty_like(data)
+        for row in range(len(data)):
+            ct_up[row], ct_down[row] = calcu_cusum(data[row], K, use_numba, init)
+        return ct_up, ct_down
+    if use_numba and numba is not None:
+        if init is None:
+            return _cusum_numba(data, K, 0.0, 0.0, 1)
+        return _cusum_numba(data, K, float(init[0]), float(init[1]), 0)
+    if init is None:
+        ct_up = _cusum_upper(data - K)
+        # The lower CUSUM is the upper one of the negated increments
+        ct_down = 0.0 - _cusum_upper(-(data + K))
+        return ct_up, ct_down
+    # Two leading values make the statistic equal init just before data[0]
+    ct_up = _cusum_upper(np.concatenate(([0.0, init[0]], data - K)))[2:]
+    ct_down = 0.0 - _cusum_upper(np.concatenate(([0.0, -init[1]], -(data + K))))[2:]
+    return ct_up, ct_down
+
+
+def find_runs(mask, min_length=1):
+    # Start and end (exclusive) of every run of True at least min_length long.
+    # The edges are found in int8, one byte per position like the mask.
+    pad = np.zeros(1, dtype=np.int8)
+    edges = np.flatnonzero(np.diff(np.concatenate((pad, mask.view(np.int8), pad))))
+    starts = edges[::2]
+    ends = edges[1::2]
+    keep = ends - starts >= min_length
+    return starts[keep], ends[keep]
+
+
+def find_cand_regs(mask, ct, min_length, reduce=np.maximum, min_size=1000):
+    # [start, end] of each run of mask, where end is the first position of the run's
+    # extreme ct value (reduce is np.maximum or np.minimum); regions shorter than min_size are dropped.
+    # For a 2-D mask (samples x positions) the rows are searched together and one list is returned per row.
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim == 2:
+        # A False column after every row keeps runs from crossing rows
+        n_rows, width = mask.shape
+        padded_mask = np.zeros((n_rows, width + 1), dtype=bool)
+        padded_mask[:, :width] = mask
+        starts, ends = find_runs(padded_mask.ravel(), min_length)
+        rows = starts // (width + 1)
+        # Positions in the flattened rows without padding
+        starts = starts - rows
+        ends = ends - rows
+        extreme_pos = find_run_extremes(starts, ends, np.ravel(ct), reduce)
+        keep = extreme_pos - starts >= min_size
+        row_regs = [[] for _ in range(n_rows)]
+        for row, start, end in zip(rows[keep].tolist(), starts[keep].tolist(), extreme_pos[keep].tolist()):
+            row_regs[row].append([start - row * width, end - row * width])
+        return row_regs
+    starts, ends = find_runs(mask, min_length)
+    extreme_pos = find_run_extremes(starts, ends, ct, reduce)
+    keep = extreme_pos - starts >= min_size
+    return np.column_stack((starts[keep], extreme_pos[keep])).tolist()
+
+
+class CandRegStream:
+    # find_cand_regs over consecutive chunks of mask and ct. A run reaching the end of a chunk is kept open
+    # (its start and first extreme) and continued by the next chunk, so the regions equal those of the
+    # whole arrays.
+
+    def __init__(self, min_length, reduce=np.maximum, min_size=1000):
+        self.min_length = min_length
+        self.reduce = reduce
+        self.min_size = min_size
+        self.offset = 0
+        self.open_run = None
+
+    def _region(self, start, end, extreme_pos):
+        if end - start >= self.min_length and extreme_pos - start >= self.min_size:
+            return [[start, extreme_pos]]
+        return []
+
+    def add(self, mask, ct):
+        # Regions completed by this chunk
+        mask = np.asarray(mask, dtype=bool)
+        offset = self.offset
+        self.offset += len(mask)
+        starts, ends = find_runs(mask)
+        extreme_pos = find_run_extremes(starts, ends, ct, self.reduce)
+        extreme_value = ct[extreme_pos]
+        starts = starts + offset
+        ends = ends + offset
+        extreme_pos = extreme_pos + offset
+
+        regions = []
+        if self.open_run is not None:
+            start, run_pos, run_value = self.open_run
+            if len(starts) and starts[0] == offset:
+                # The open run continues; an equal extreme keeps the earlier position
+                if self.reduce(extreme_value[0], run_value) != run_value:
+                    run_pos, run_value = extreme_pos[0], extreme_value[0]
+                starts[0] = start
+                extreme_pos[0] = run_pos
+                extreme_value[0] = run_value
+            else:
+                regions += self._region(start, offset, run_pos)
+            self.open_run = None
+        if len(starts) and ends[-1] == self.offset:
+            self.open_run = (starts[-1], extreme_pos[-1], extreme_value[-1])
+            starts, ends, extreme_pos = starts[:-1], ends[:-1], extreme_pos[:-1]
+        keep = (ends - starts >= self.min_length) & (extreme_pos - starts >= self.min_size)
+        return regions + np.column_stack((starts[keep], extreme_pos[keep])).tolist()
+
+    def finish(self):
+        # The region of a run reaching the end of the last chunk
+        regions = []
+        if self.open_run is not None:
+            start, run_pos, run_value = self.open_run
+            regions = self._region(int(start), self.offset, int(run_pos))
+            self.open_run = None
+        return regions
+
+
+def find_run_extremes(starts, ends, ct, reduce=np.maximum):
+    # Position of the first extreme ct value in each run [starts, ends)
+    if len(starts) == 0:
+        return starts
+    lengths = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    run_values = ct[np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())]
+    run_extreme = reduce.reduceat(run_values, offsets)
+    hits = np.flatnonzero(run_values == np.repeat(run_extreme, lengths))
+    return starts + hits[np.searchsorted(hits, offsets)] - offsets
+
+
+def baseline_stat_file(baseline_path, stat, chr_name):
+    return os.path.join(baseline_path, f'{stat}_{chr_name}.npy')
+
+
+def load_baseline_meta(baseline_path):
+    # Sample count, sample names and chromosome lengths of a baseline store, None if there is none
+    meta_file = os.path.join(baseline_path, 'baseline_store.json')
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, 'r') as f:
+        return json.load(f)
+
+
+def save_baseline_meta(baseline_path, meta):
+    with open(os.path.join(baseline_path, 'baseline_store.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+def baseline_stats(meta):
+    return ['sum', 'sumsq'] if meta['sumsq'] else ['sum']
+
+
+def baseline_mean_file(baseline_path, chr_name):
+    return os.path.join(baseline_path, f'baseline_file_{chr_name}.npy')
+
+
+def calcu_baseline(chr_len_list, sample_depths, dtype=np.float32):
+    # The baseline build_baseline_store writes, in memory: the mean of sample_depths as dtype, per chromosome
+    baseline = {}
+    for chr_name, chr_len in chr_len_list:
+        cb_data = np.zeros(chr_len)
+        for sample_depth in sample_depths:
+            cb_data = cb_data + sample_depth[chr_name]
+        baseline[chr_name] = (cb_data / len(sample_depths)).astype(dtype)
+    return baseline
+
+
+def build_baseline_store(baseline_path, chr_len_list, sample_names, sample_depths, sumsq=False, update=False,
+                         dtype=np.float32, bin_size=1):
+    # Per-position running sums (and optionally sums of squares) of the baseline samples.
+    # With update, the samples are added to the store already at baseline_path.
+    # The baseline used by ZIP-Caller (sum / n_samples) is written next to it as one dtype array per chromosome.
+    # With bin_size > 1, chr_len_list holds the number of bins of each chromosome.
+    os.makedirs(baseline_path, exist_ok=True)
+    meta = load_baseline_meta(baseline_path) if update else None
+    if meta is None:
+        meta = {'n_samples': 0, 'samples': [], 'sumsq': sumsq, 'bin_size': bin_size,
+                'chr_len': {chr_name: chr_len for chr_name, chr_len in chr_len_list}}
+    if meta.get('bin_size', 1) != bin_size:
+        raise ValueError(f'bin_size is {bin_size}, but {meta.get("bin_size", 1)} in the baseline store')
+    if sumsq and not meta['sumsq']:
+        # The squares of the samples already in the store are gone
+        raise ValueError('The baseline store has no sums of squares; rebuild it with -sumsq instead of updating it')
+    for chr_name, chr_len in chr_len_list:
+        if meta['chr_len'].get(chr_name) != chr_len:
+            raise ValueError(f'{chr_name} has length {chr_len}, but {meta["chr_len"].get(chr_name)} in the baseline store')
+    duplicates = set(meta['samples']) & set(sample_names)
+    if duplicates:
+        raise ValueError(f'Samples already in the baseline store: {sorted(duplicates)}')
+
+    n_samples = meta['n_samples'] + len(sample_names)
+    for chr_name, chr_len in chr_len_list:
+        for stat in baseline_stats(meta):
+            if meta['n_samples'] > 0:
+                cb_data = np.load(baseline_stat_file(baseline_path, stat, chr_name))
+            else:
+                cb_data = np.zeros(chr_len)
+            for sample_depth in sample_depths:
+                if stat == 'sum':
+                    cb_data = cb_data + sample_depth[chr_name]
+                else:
+                    cb_data = cb_data + np.square(sample_depth[chr_name], dtype=np.float64)
+            np.save(baseline_stat_file(baseline_path, stat, chr_name), cb_data)
+            if stat == 'sum':
+                np.save(baseline_mean_file(baseline_path, chr_name), (cb_data / n_samples).astype(dtype))
+
+    meta['n_samples'] = n_samples
+    meta['samples'] += list(sample_names)
+    meta['dtype'] = np.dtype(dtype).name
+    save_baseline_meta(baseline_path, meta)
+    return meta
+
+
+def merge_baseline_stores(store_paths, baseline_path, dtype=np.float32):
+    # Add up baseline stores built from disjoint sets of samples
+    metas = [load_baseline_meta(store_path) for store_path in store_paths]
+    for store_path, meta in zip(store_paths, metas):
+        if meta is None:
+            raise FileNotFoundError(f'No baseline store in {store_path}')
+        if meta['chr_len'] != metas[0]['chr_len'] or meta.get('bin_size', 1) != metas[0].get('bin_size', 1):
+            raise ValueError(f'{store_path} was built on other chromosomes or bins than {store_paths[0]}')
+    samples = [sample for meta in metas for sample in meta['samples']]
+    if len(set(samples)) != len(samples):
+        raise ValueError('The same sample is in more than one baseline store')
+
+    merged = {'n_samples': len(samples), 'samples': samples, 'sumsq': all(meta['sumsq'] for meta in metas),
+              'bin_size': metas[0].get('bin_size', 1), 'chr_len': metas[0]['chr_len'], 'dtype': np.dtype(dtype).name}
+    os.makedirs(baseline_path, exist_ok=True)
+    for chr_name in merged['chr_len']:
+        for stat in baseline_stats(merged):
+            cb_data = np.zeros(merged['chr_len'][chr_name])
+            for store_path in store_paths:
+                cb_data = cb_data + np.load(baseline_stat_file(store_path, stat, chr_name))
+            np.save(baseline_stat_file(baseline_path, stat, chr_name), cb_data)
+            if stat == 'sum':
+                np.save(baseline_mean_file(baseline_path, chr_name), (cb_data / merged['n_samples']).astype(dtype))
+    save_baseline_meta(baseline_path, merged)
+    return merged
+
+
+def merge_baseline_shards(store_paths, baseline_path, chr_len_list):
+    # Combine baseline stores built from the same samples on disjoint chromosomes (data_processing.py -shard)
+    # into one store over chr_len_list, as if it had been built in one run
+    metas = [load_baseline_meta(store_path) for store_path in store_paths]
+    store_of_chr = {}
+    for store_path, meta in zip(store_paths, metas):
+        if meta is None:
+            raise FileNotFoundError(f'No baseline store in {store_path}')
+        if any(meta[key] != metas[0][key] for key in ['samples', 'sumsq', 'bin_size', 'dtype']):
+            raise ValueError(f'{store_path} was built from other samples or settings than {store_paths[0]}')
+        for chr_name in meta['chr_len']:
+            if chr_name in store_of_chr:
+                raise ValueError(f'{chr_name} is in both {store_of_chr[chr_name]} and {store_path}')
+            store_of_chr[chr_name] = store_path
+    merged = {'n_samples': metas[0]['n_samples'], 'samples': metas[0]['samples'], 'sumsq': metas[0]['sumsq'],
+              'bin_size': metas[0]['bin_size'], 'chr_len': {}}
+    os.makedirs(baseline_path, exist_ok=True)
+    for chr_name, chr_len in chr_len_list:
+        if chr_name not in store_of_chr:
+            raise ValueError(f'{chr_name} is in none of the baseline stores')
+        merged['chr_len'][chr_name] = chr_len
+        for stat in baseline_stats(merged):
+            shutil.copyfile(baseline_stat_file(store_of_chr[chr_name], stat, chr_name),
+                            baseline_stat_file(baseline_path, stat, chr_name))
+        shutil.copyfile(baseline_mean_file(store_of_chr[chr_name], chr_name),
+                        baseline_mean_file(baseline_path, chr_name))
+    merged['dtype'] = metas[0]['dtype']
+    save_baseline_meta(baseline_path, merged)
+    return merged
+
+
+def open_baseline(baseline_path, chr_len_list, dtype=np.float32):
+    # Memory-map the baseline of every chromosome; pages are only read when a chromosome is used.
+    # Stores without baseline files and .npz baselines from earlier versions are converted once.
+    meta = load_baseline_meta(baseline_path)
+    baseline_data = {}
+    for chr_name, chr_len in chr_len_list:
+        file_path = baseline_mean_file(baseline_path, chr_name)
+        if not os.path.isfile(file_path):
+            if meta is not None:
+                baseline = np.load(baseline_stat_file(baseline_path, 'sum', chr_name)) / meta['n_samples']
+            else:
+                with np.load(os.path.join(baseline_path, f'baseline_file_{chr_name}.npz')) as data:
+                    baseline = data[chr_name]
+            print(f'convert the baseline of {chr_name} to {file_path} ..................')
+            np.save(file_path, baseline.astype(dtype))
+        baseline_data[chr_name] = np.load(file_path, mmap_mode='r')
+    return baseline_data
+
+
+def parse_shard(value):
+    # '-shard i/N': (i, N) with 0 <= i < N
+    shard_idx, n_shards = (int(part) for part in value.split('/'))
+    if not 0 <= shard_idx < n_shards:
+        raise ValueError(f'shard {value} is not in 0/N .. N-1/N')
+    return shard_idx, n_shards
+
+
+def shard_name(shard):
+    return f'shard_{shard[0]}_of_{shard[1]}'
+
+
+def log_message(log_filename, message):
+    current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+    print(message)
+    with open(log_filename, "a") as log_file:
+        log_file.write(f"{current_time}:{message}\n")
+
+
+def log_error(log_filename, filename, e):
+    current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+    error_message = f"{current_time}:Error occurred while reading {filename}: {e}"
+    print(error_message)
+    # Write the error message to the log file
+    with open(log_filename, "a") as log_file:
+        log_file.write(error_message + "\n")
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far in MB (ru_maxrss is in kB on Linux), None without resource
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def io_bytes():
+    # (bytes read, bytes written) by this process through system calls, None without /proc/self/io.
+    # Pages of memory-mapped files are not included.
+    try:
+        with open('/proc/self/io', 'r') as file:
+            fields = dict(line.split(':', 1) for line in file.read().splitlines() if ':' in line)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def chr_label(chr_len_list):
+    # Chromosome label of a unit covering chr_len_list
+    return chr_len_list[0][0] if len(chr_len_list) == 1 else 'all'
+
+
+class StageProfiler:
+    # Wall time, peak RSS, bytes read / written and read counts of the named stages of a run.
+    # Every process has one (profiler below); records of pool workers come back through run_profiled.
+
+    def __init__(self):
+        self.records = []
+        self.start_time = time.time()
+
+    @contextmanager
+    def stage(self, name, **labels):
+        # Yields the record, so a stage can add counters such as 'reads'
+        record = {'stage': name}
+        record.update(labels)
+        io_st = io_bytes()
+        st = time.time()
+        try:
+            yield record
+        finally:
+            record['sec'] = time.time() - st
+            record['peak_rss_mb'] = peak_rss_mb()
+            io_et = io_bytes()
+            if io_st is not None and io_et is not None:
+                record['read_mb'] = (io_et[0] - io_st[0]) / 1e6
+                record['write_mb'] = (io_et[1] - io_st[1]) / 1e6
+            if 'reads' in record and record['sec'] > 0:
+                record['reads_per_sec'] = record['reads'] / record['sec']
+            record['pid'] = os.getpid()
+            self.records.append(record)
+
+    def summary(self):
+        # Totals per stage, in order of first appearance
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record['stage'], {'count': 0, 'sec': 0.0, 'peak_rss_mb': None})
+            total['count'] += 1
+            total['sec'] += record['sec']
+            if record['peak_rss_mb'] is not None:
+                total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, record['peak_rss_mb'])
+            for key in ['read_mb', 'write_mb', 'reads']:
+                if key in record:
+                    total[key] = total.get(key, 0) + record[key]
+        for total in stages.values():
+            if 'reads' in total and total['sec'] > 0:
+                total['reads_per_sec'] = total['reads'] / total['sec']
+        return stages
+
+    def write_report(self, report_prefix, **run_info):
+        # <report_prefix>.json with the run, the stage totals and every record; <report_prefix>.csv with the records
+        os.makedirs(os.path.dirname(report_prefix) or '.', exist_ok=True)
+        report = dict(run_info)
+        report.update({'total_sec': time.time() - self.start_time, 'peak_rss_mb': peak_rss_mb(),
+                       'stages': self.summary(), 'records': self.records})
+        with open(report_prefix + '.json', 'w') as file:
+            json.dump(report, file, indent=4)
+        fieldnames = []
+        for record in self.records:
+            fieldnames += [key for key in record if key not in fieldnames]
+        with open(report_prefix + '.csv', 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(self.records)
+        return report_prefix + '.json', report_prefix + '.csv'
+
+
+profiler = StageProfiler()
+
+
+def run_profiled(func, *args, **kwargs):
+    # func(*args, **kwargs) in a pool worker: returns its result and the profile records it added
+    n_records = len(profiler.records)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        records = profiler.records[n_records:]
+        del profiler.records[n_records:]
+    return result, records
+
+
+def run_with_cprofile(func, profile_file, n_lines=40):
+    # func() under cProfile: stats to profile_file, the top n_lines by cumulative time to profile_file.txt
+    os.makedirs(os.path.dirname(profile_file) or '.', exist_ok=True)
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func)
+    finally:
+        prof.dump_stats(profile_file)
+        with open(profile_file + '.txt', 'w') as file:
+            pstats.Stats(prof, stream=file).sort_stats('cumulative').print_stats(n_lines)
+
+
 def read_config(file_path):
     paths = {}
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -152,3 +1158,70 @@ def load_from_json(input_file):
 
     return standardized_depths
 
+
+def save2json(standardized_depths, filename):
+    # Convert numpy arrays to lists for JSON serialization
+    standardized_depths_serializable = {}
+    for chr_name, standardized_depth in standardized_depths.items():
+        standardized_depths_serializable[chr_name] = standardized_depth.tolist()
+
+    # Write to JSON file
+    with open(filename, 'w') as jsonfile:
+        json.dump(standardized_depths_serializable, jsonfile)
+
+
+def save2npy(standardized_depths, out_dir, dtype=np.float32):
+    # One file per chromosome, so each can be loaded on its own:
+    # <chr>.npy for dense arrays (memory-mapped when read), <chr>.rle.npz for RunLengthDepth
+    os.makedirs(out_dir, exist_ok=True)
+    for chr_name, standardized_depth in standardized_depths.items():
+        dense_file = os.path.join(out_dir, f'{chr_name}.npy')
+        rle_file = os.path.join(out_dir, f'{chr_name}.rle.npz')
+        if isinstance(standardized_depth, RunLengthDepth):
+            standardized_depth.save(rle_file, dtype=dtype)
+            stale_file = dense_file
+        else:
+            np.save(dense_file, np.asarray(standardized_depth, dtype=dtype))
+            stale_file = rle_file
+        if os.path.isfile(stale_file):
+            os.remove(stale_file)
+
+
+def load_depth_file(input_dir, chr_name, mmap_mode='r'):
+    rle_file = os.path.join(input_dir, f'{chr_name}.rle.npz')
+    if os.path.isfile(rle_file):
+        return RunLengthDepth.load(rle_file)
+    return np.load(os.path.join(input_dir, f'{chr_name}.npy'), mmap_mode=mmap_mode)
+
+
+def load_from_npy(input_dir, mmap_mode='r', chr_names=None):
+    # With chr_names, only these chromosomes are opened
+    standardized_depths = {}
+    for file_name in sorted(os.listdir(input_dir)):
+        for suffix in ['.rle.npz', '.npy']:
+            if file_name.endswith(suffix):
+                chr_name = file_name[:-len(suffix)]
+                if chr_names is not None and chr_name not in chr_names:
+                    break
+                standardized_depths[chr_name] = load_depth_file(input_dir, chr_name, mmap_mode=mmap_mode)
+                break
+
+    return standardized_depths
+
+
+def json2npy(input_file, out_dir, dtype=np.float32):
+    # Convert a data/nor/*.json file written by earlier versions
+    save2npy(load_from_json(input_file), out_dir, dtype=dtype)
+
+
+def load_std_depth(nor_dir, file_name, dtype=np.float32, mmap_mode='r', chr_names=None):
+    # Open the standardized depth of a sample, converting a legacy JSON file on first use
+    sample_name = os.path.basename(file_name).replace('.bam', '')
+    npy_dir = os.path.join(nor_dir, sample_name)
+    json_file = os.path.join(nor_dir, sample_name + '.json')
+    if not os.path.isdir(npy_dir):
+        if not os.path.isfile(json_file):
+            raise FileNotFoundError(f'No standardized depth for {file_name} in {nor_dir}')
+        print(f'convert {json_file} to {npy_dir} ..................')
+        json2npy(json_file, npy_dir, dtype=dtype)
+    return load_from_npy(npy_dir, mmap_mode=mmap_mode, chr_names=chr_names)
@@ -6,100 +6,86 @@ from tqdm import trange
 import os
 from datetime import datetime
 import csv
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-config', type=str, help="Path to the parameter_cfg.config", required=True)
-parser.add_argument('-o', type=str, help="Path to the output file", required=True)
-parser.add_argument('-n', type=int, default=3000, help="Sliding window size")
-parser.add_argument('-k', type=float, default=0.3, help="The reference value for the allowed degree of deviation.")
-
-args = parser.parse_args()
+# Columns of the .cnv output
+CNV_COLUMNS = ['SampleID', 'Chromosome', 'Start', 'End', 'LogR_Ratio', 'CNV_Type', 'Window']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', type=str, help="Path to the parameter_cfg.config", required=True)
+    parser.add_argument('-o', type=str, help="Path to the output file", required=True)
+    parser.add_argument('-n', type=int, nargs='+', default=[3000],
+                        help="Sliding window sizes; every size is evaluated from the same prefix-sum index")
+    parser.add_argument('-k', type=float, default=0.3, help="The reference value for the allowed degree of deviation.")
+    parser.add_argument('-workers', type=int, default=1, help="Number of processes calling (sample, chromosome) units")
+    parser.add_argument('-batch', type=int, default=0,
+                        help="Call this many test samples together as one samples x positions matrix per chromosome "
+                             "(0: one sample at a time)")
+    parser.add_argument('-chunk_size', type=int, default=0,
+                        help="Call each chromosome in chunks of this many positions (bins with bin_size > 1), "
+                             "so memory does not grow with the chromosome length (0: whole chromosomes)")
+    parser.add_argument('-profile', action='store_true',
+                        help="Run under cProfile and write the hotspot stats to log/")
+    parser.add_argument('-checkpoint', type=str,
+                        help="Record finished (sample, chromosome) units in this directory and resume from them "
+                             "after a restart")
+    parser.add_argument('-shard', type=parse_shard,
+                        help="Call shard i/N (0 <= i < N) of the job into zipcaller_res_shard_i_of_N.cnv, "
+                             "e.g. the SLURM array task $SLURM_ARRAY_TASK_ID")
+    parser.add_argument('-shard_by', choices=['sample', 'chromosome'], default='sample',
+                        help="Call every N-th test sample, or every N-th chromosome of all test samples")
+    parser.add_argument('-merge', type=str, nargs='+',
+                        help="Merge these shard outputs into one .cnv file in -o and exit")
+
+    args = parser.parse_args(argv)
+    if args.batch > 0 and args.chunk_size > 0:
+        parser.error('-batch and -chunk_size cannot be combined')
+    return args
 
 
 def calcu_win_depth(data, pgg, window_size):
-    win_depth = []
-    for i in range(len(data) - window_size + 1):
-        x_bar = np.mean(data[i:i + window_size])
-        p_bar = np.mean(pgg[i:i + window_size])
-        s_bar = np.log(x_bar / p_bar)
-        win_depth.append(s_bar)
-    return win_depth
-
-
-def calcu_ct(data, K):
-    ct_up = np.zeros(len(data))
-    ct_down = np.zeros(len(data))
-    for i in range(len(data)):
-        if i == 0:
-            ct_up[i] = 0
-            ct_down[i] = 0
-        else:
-            ct_up[i] = np.max([0, data[i] - K + ct_up[i - 1]])
-            ct_down[i] = np.min([0, data[i] + K + ct_down[i - 1]])
-    return ct_up, ct_down
-
-
-def find_continuous_up_segments(ct, H_pos, min_length):
-    up_segments = []
-    current_segment = []
-
-    for i, num in enumerate(ct):
-        if num >= H_pos:
-            current_segment.append((i, num))
+    return next(calcu_win_depths(data, pgg, [window_size]))[1]
+
+
+def calcu_win_depths(data, pgg, window_sizes, pgg_index=None):
+    # (window_size, calcu_win_depth) for every window size, one at a time.
+    # data and pgg are indexed once; each window size then costs O(n) without reading them again.
+    # data may be a samples x positions matrix, or a list of RunLengthDepth rows whose window sums are taken
+    # from their runs; pgg_index is an index of pgg already built for max(window_sizes)
+    block_size = max(window_sizes)
+    sparse = isinstance(data, list)
+    data_index = None if sparse else calcu_win_index(data, block_size)
+    if pgg_index is None:
+        pgg_index = calcu_win_index(pgg, block_size)
+    for window_size in window_sizes:
+        if sparse:
+            x_bar = np.array([row.win_sum(window_size) for row in data])
         else:
-            if len(current_segment) >= min_length:
-                up_segments.append(current_segment)
-            current_segment = []
+            x_bar = index_win_sum(data_index, window_size)
+        # In place: for a batch, x_bar is as large as the samples x positions matrix
+        x_bar /= window_size
+        p_bar = index_win_sum(pgg_index, window_size) / window_size
+        # Empty windows give inf/nan as before, without a warning per window
+        with np.errstate(divide='ignore', invalid='ignore'):
+            win_depth = np.log(np.divide(x_bar, p_bar, out=x_bar), out=x_bar)
+        yield window_size, win_depth
 
-    if len(current_segment) >= min_length:
-        up_segments.append(current_segment)
 
-    return up_segments
+def calcu_ct(data, K, init=None):
+    return calcu_cusum(data, K, init=init)
 
 
-def find_continuous_down_segments(ct, H_neg, min_length):
-    down_segments = []
-    current_segment = []
+def find_cand_dup_regs(ct_up, H_pos, min_length, min_size=1000):
+    # Runs of ct_up >= H_pos, from the run start to the position of its maximum
+    return find_cand_regs(ct_up >= H_pos, ct_up, min_length, np.maximum, min_size)
 
-    for i, num in enumerate(ct):
-        if num <= H_neg:
-            current_segment.append((i, num))
-        else:
-            if len(current_segment) >= min_length:
-                down_segments.append(current_segment)
-            current_segment = []
-
-    if len(current_segment) >= min_length:
-        down_segments.append(current_segment)
-
-    return down_segments
 
-
-def find_cand_dup_regs(result):
-    cand_cnv_regs = []
-    if result:
-        for res in result:
-            start = res[0][0]
-            end = max(res, key=lambda item: item[1])[0]
-            if end - start >= 1000:
-                cand_cnv_regs.append([start, end])
-        return cand_cnv_regs
-    else:
-        return []
-
-
-def find_cand_del_regs(result):
-    cand_cnv_regs = []
-    if result:
-        for res in result:
-            start = res[0][0]
-            end = min(res, key=lambda item: item[1])[0]
-            if end - start >= 1000:
-                cand_cnv_regs.append([start, end])
-        return cand_cnv_regs
-    else:
-        return []
+def find_cand_del_regs(ct_down, H_neg, min_length, min_size=1000):
+    # Runs of ct_down <= H_neg, from the run start to the position of its minimum
+    return find_cand_regs(ct_down <= H_neg, ct_down, min_length, np.minimum, min_size)
 
 
 def calcu_logr(cand_cnv_regs, sample_depth, pgg_depth, chr_name, sample):
@@ -123,17 +109,268 @@ def calcu_logr(cand_cnv_regs, sample_depth, pgg_depth, chr_name, sample):
     return det_results
 
 
-def main():
+def read_baseline_chr(b, chr_name=None):
+    # Read one memory-mapped baseline chromosome into memory, timing the read
+    st = time.time()
+    with profiler.stage('baseline_read', chromosome=chr_name):
+        b = np.array(b, dtype=np.float64)
+    return b, time.time() - st
+
+
+def bin_windows(slide_wins, bin_size):
+    # Sliding window sizes in bins
+    return {slide_win: max(slide_win // bin_size, 1) for slide_win in slide_wins}
+
+
+def check_chr_len(s, b, chr_name, bin_size):
+    if len(s) != len(b):
+        raise ValueError(f'{chr_name} has {len(s)} positions, but {len(b)} in the baseline (bin_size {bin_size})')
+
+
+def call_cnv(s, b, chr_name, sample, slide_wins, K, bin_size=1):
+    # All CNV calls of one sample on one chromosome, for every sliding window size in slide_wins.
+    # Each call ends with the window size that produced it.
+    # With bin_size > 1, s and b hold bin means: the window and region lengths are converted to bins,
+    # and the regions back to bases
+    check_chr_len(s, b, chr_name, bin_size)
+    if isinstance(s, RunLengthDepth):
+        # Window sums come from the runs, so s is not expanded to a per-base array
+        rows = [s.astype(np.float64)]
+    else:
+        rows = np.asarray(s, dtype=np.float64)[None, :]
+    return call_cnv_batch(rows, b, chr_name, [sample], slide_wins, K, bin_size)[0]
+
+
+def call_cnv_batch(rows, b, chr_name, samples, slide_wins, K, bin_size=1, b_index=None):
+    # call_cnv for a samples x positions matrix (or a list of RunLengthDepth rows): window statistics, CUSUM and
+    # candidate regions are computed for all rows at once. Returns the calls of each sample. b_index is an index
+    # of b from calcu_win_index for the largest window in bins, so a baseline chromosome is indexed once for the
+    # whole cohort.
+    bin_wins = bin_windows(slide_wins, bin_size)
+    min_length = max(10000 // bin_size, 1)
+    min_size = 1000 // bin_size
+
+    results = [[] for _ in samples]
+    labels = {'sample': ','.join(samples), 'chromosome': chr_name}
+    wins = sorted(set(bin_wins.values()))
+    win_depths = calcu_win_depths(rows, b, wins, b_index)
+    for bin_win in wins:
+        # The first window size also builds the prefix-sum index
+        with profiler.stage('window', window=bin_win, **labels):
+            bin_win, cusum_statistic = next(win_depths)
+        H_pos = np.log2(1.5) * bin_win
+        H_neg = np.log2(0.5) * bin_win
+        with profiler.stage('cusum', window=bin_win, **labels):
+            ct_up, ct_down = calcu_ct(cusum_statistic, K)
+        with profiler.stage('segments', window=bin_win, **labels):
+            cand_dup_regs = find_cand_dup_regs(ct_up, H_pos=H_pos, min_length=min_length, min_size=min_size)
+            cand_down_regs = find_cand_del_regs(ct_down, H_neg=H_neg, min_length=min_length, min_size=min_size)
+        del cusum_statistic, ct_up, ct_down
+
+        for row, sample in enumerate(samples):
+            win_results = []
+            with profiler.stage('logr', window=bin_win, sample=sample, chromosome=chr_name):
+                if cand_dup_regs[row]:
+                    win_results += calcu_logr(cand_dup_regs[row], {chr_name: rows[row]}, {chr_name: b}, chr_name,
+                                              sample)
+                if cand_down_regs[row]:
+                    win_results += calcu_logr(cand_down_regs[row], {chr_name: rows[row]}, {chr_name: b}, chr_name,
+                                              sample)
+            for slide_win in slide_wins:
+                if bin_wins[slide_win] == bin_win:
+                    results[row] += [result[:2] + [result[2] * bin_size, result[3] * bin_size] + result[4:] +
+                                     [slide_win] for result in win_results]
+    return results
+
+
+def call_cnv_stream(s, b, chr_name, sample, slide_wins, K, bin_size=1, chunk_size=1000000):
+    # call_cnv over chunks of chunk_size positions, rounded up to a multiple of the largest window so the
+    # window sums use the same prefix-sum blocks as a whole chromosome. s and b may be memory-mapped or
+    # run-length encoded: only a chunk plus the window tail after it is read at a time. Each window size
+    # carries its CUSUM values and open candidate regions into the next chunk, so the calls equal call_cnv's.
+    check_chr_len(s, b, chr_name, bin_size)
+    bin_wins = bin_windows(slide_wins, bin_size)
+    wins = sorted(set(bin_wins.values()))
+    block_size = max(wins)
+    chunk_size = -(-max(chunk_size, 1) // block_size) * block_size
+    min_length = max(10000 // bin_size, 1)
+    min_size = 1000 // bin_size
+
+    ct_state = dict.fromkeys(wins)
+    dup_streams = {w: CandRegStream(min_length, np.maximum, min_size) for w in wins}
+    del_streams = {w: CandRegStream(min_length, np.minimum, min_size) for w in wins}
+    cand_dup_regs = {w: [] for w in wins}
+    cand_down_regs = {w: [] for w in wins}
+    labels = {'sample': sample, 'chromosome': chr_name}
+    n = len(s)
+    for chunk_st in range(0, n, chunk_size):
+        chunk_et = min(chunk_st + chunk_size + block_size, n)
+        with profiler.stage('chunk_read', **labels):
+            data = np.asarray(s[chunk_st:chunk_et], dtype=np.float64)
+            pgg = np.asarray(b[chunk_st:chunk_et], dtype=np.float64)
+        win_depths = calcu_win_depths(data, pgg, wins)
+        for bin_win in wins:
+            with profiler.stage('window', window=bin_win, **labels):
+                bin_win, cusum_statistic = next(win_depths)
+            # Windows starting in this chunk
+            cusum_statistic = cusum_statistic[:min(chunk_size, n - bin_win + 1 - chunk_st)]
+            if len(cusum_statistic) == 0:
+                continue
+            with profiler.stage('cusum', window=bin_win, **labels):
+                ct_up, ct_down = calcu_ct(cusum_statistic, K, ct_state[bin_win])
+            ct_state[bin_win] = (ct_up[-1], ct_down[-1])
+            with profiler.stage('segments', window=bin_win, **labels):
+                cand_dup_regs[bin_win] += dup_streams[bin_win].add(ct_up >= np.log2(1.5) * bin_win, ct_up)
+                cand_down_regs[bin_win] += del_streams[bin_win].add(ct_down <= np.log2(0.5) * bin_win, ct_down)
+        del data, pgg, win_depths
+
+    results = []
+    for bin_win in wins:
+        win_results = []
+        with profiler.stage('logr', window=bin_win, **labels):
+            for reg in cand_dup_regs[bin_win] + dup_streams[bin_win].finish() + \
+                    cand_down_regs[bin_win] + del_streams[bin_win].finish():
+                win_results += calcu_logr_mapped(reg, s, b, chr_name, sample)
+        for slide_win in slide_wins:
+            if bin_wins[slide_win] == bin_win:
+                results += [result[:2] + [result[2] * bin_size, result[3] * bin_size] + result[4:] + [slide_win]
+                            for result in win_results]
+    return results
+
+
+def calcu_logr_mapped(reg, s, b, chr_name, sample):
+    # calcu_logr of one region, reading only that region of s and b
+    reg_st, reg_et = int(reg[0]), int(reg[1])
+    results = calcu_logr([[0, reg_et - reg_st]], {chr_name: np.asarray(s[reg_st:reg_et], dtype=np.float64)},
+                         {chr_name: np.asarray(b[reg_st:reg_et], dtype=np.float64)}, chr_name, sample)
+    return [result[:2] + [reg_st, reg_et] + result[4:] for result in results]
+
+
+def stack_rows(depths, length):
+    # samples x positions float64 matrix, allocated once and filled row by row from the (memory-mapped) depths,
+    # so the cohort is not held twice
+    rows = np.empty((len(depths), length))
+    for row, depth in enumerate(depths):
+        rows[row] = depth
+    return rows
+
+
+def call_batch_chr(sample_dirs, samples, chr_name, b, slide_wins, K, bin_size=1):
+    # Stack one chromosome of every sample into a matrix and call them together.
+    # Returns the calls of each sample, or the exception that kept it out of the matrix
+    depths = []
+    stacked = []
+    results = [None] * len(samples)
+    for idx, sample_dir in enumerate(sample_dirs):
+        try:
+            s = load_depth_file(sample_dir, chr_name)
+            check_chr_len(s, b, chr_name, bin_size)
+            depths.append(s)
+            stacked.append(idx)
+        except Exception as e:
+            results[idx] = e
+    if stacked:
+        rows = stack_rows(depths, len(b))
+        del depths
+        b_index = calcu_win_index(b, max(bin_windows(slide_wins, bin_size).values()))
+        batch_results = call_cnv_batch(rows, b, chr_name, [samples[idx] for idx in stacked], slide_wins,
+                                       K, bin_size, b_index)
+        for idx, sample_results in zip(stacked, batch_results):
+            results[idx] = sample_results
+    return results
+
+
+def merge_cnv_files(cnv_files, output_file, samples, chr_names):
+    # Rows of shard outputs in (sample, chromosome) order, as one run writes them.
+    # The outputs of every shard 0..N-1 of the job are needed, each once: without one the output would be partial.
+    shards = set()
+    for cnv_file in cnv_files:
+        name = os.path.basename(cnv_file)
+        try:
+            if not (name.startswith('zipcaller_res_shard_') and name.endswith('.cnv')):
+                raise ValueError(name)
+            shards.add(parse_shard(name[len('zipcaller_res_shard_'):-len('.cnv')].replace('_of_', '/')))
+        except ValueError:
+            raise ValueError(f'{cnv_file} is not the output of a zip_caller.py -shard run')
+    if len(shards) != len(cnv_files):
+        raise ValueError('The output of a shard is given more than once')
+    n_shards = {n for shard_idx, n in shards}
+    if len(n_shards) != 1:
+        raise ValueError(f'The outputs are from jobs of {sorted(n_shards)} shards')
+    n_shards = n_shards.pop()
+    missing = sorted(set(range(n_shards)) - {shard_idx for shard_idx, n in shards})
+    if missing:
+        raise ValueError(f'The outputs of shards {missing} of {n_shards} are missing')
+    units = {}
+    unit_files = {}
+    for cnv_file in cnv_files:
+        with open(cnv_file, 'r', newline='') as file:
+            csv_reader = csv.reader(file, delimiter='\t')
+            if next(csv_reader, None) != CNV_COLUMNS:
+                raise ValueError(f'{cnv_file} is not a ZIP-Caller output')
+            for row in csv_reader:
+                unit = (row[0], row[1])
+                if unit_files.setdefault(unit, cnv_file) != cnv_file:
+                    raise ValueError(f'{unit} is in both {unit_files[unit]} and {cnv_file}')
+                units.setdefault(unit, []).append(row)
+    unknown = set(units) - {(sample, chr_name) for sample in samples for chr_name in chr_names}
+    if unknown:
+        raise ValueError(f'Calls of samples or chromosomes not in the .config files: {sorted(unknown)[:5]}')
+    with open(output_file, 'w', newline='') as file:
+        csv_writer = csv.writer(file, delimiter='\t')
+        csv_writer.writerow(CNV_COLUMNS)
+        for sample in samples:
+            for chr_name in chr_names:
+                csv_writer.writerows(units.get((sample, chr_name), []))
+    return sum(len(rows) for rows in units.values())
+
+
+def call_unit_inputs(sample_dir, baseline_path, chr_name):
+    # The files a (sample, chromosome) unit is called from: its standardized depth and the baseline
+    return [depth_file_path(sample_dir, chr_name), baseline_mean_file(baseline_path, chr_name)]
+
+
+def write_unit(csv_writer, checkpoint, sample, chr_name, results, inputs=()):
+    # Rows of one (sample, chromosome) unit: to the output, or with a checkpoint to a fragment merged at the end
+    if checkpoint is None:
+        for result in results:
+            csv_writer.writerow(result)
+    else:
+        checkpoint.write_rows(sample, 'call', chr_name, results, inputs)
+
+
+# Baseline chromosomes, memory-mapped once per worker process
+worker_baseline = {}
+
+
+def init_worker(baseline_files):
+    for chr_name, file_path in baseline_files.items():
+        worker_baseline[chr_name] = np.load(file_path, mmap_mode='r')
+
+
+def call_sample_chr(sample_dir, chr_name, sample, slide_wins, K, bin_size=1, chunk_size=0):
+    s = load_depth_file(sample_dir, chr_name)
+    if chunk_size > 0:
+        return call_cnv_stream(s, worker_baseline[chr_name], chr_name, sample, slide_wins, K, bin_size,
+                               chunk_size), 0
+    b, read_sec = read_baseline_chr(worker_baseline[chr_name], chr_name)
+    return call_cnv(s, b, chr_name, sample, slide_wins, K, bin_size), read_sec
+
+
+def call_batch_chr_worker(sample_dirs, samples, chr_name, slide_wins, K, bin_size=1):
+    b, read_sec = read_baseline_chr(worker_baseline[chr_name], chr_name)
+    return call_batch_chr(sample_dirs, samples, chr_name, b, slide_wins, K, bin_size), read_sec
+
+
+def main(args):
     # .config file
     config_file_path = args.config
     paths = read_config(config_file_path)
 
     # The parameter of ZIP-Caller.
     # Please refer to the supplementary materials for setup details.
-    slide_win = args.n
+    slide_wins = sorted(set(args.n))
     K = args.k
-    H_pos = np.log2(1.5) * slide_win
-    H_neg = np.log2(0.5) * slide_win
 
     # Input: Sample files to be tested.
     test_file_list = paths['test_file_list']
@@ -143,13 +380,36 @@ def main():
     chr_len_path = paths['chr_len_path']
     chr_len_list = read_chr_len_file(chr_len_path)
 
+    # Depths are mean depths of bin_size bases, as written by data_processing.py
+    bin_size = int(paths.get('bin_size', 1))
+    chr_len_list = bin_chr_len_list(chr_len_list, bin_size)
+
+    # Gather the outputs of a sharded job
+    if args.merge:
+        test_samples = [os.path.basename(test_df.loc[test_df['mapping'] == f"sample_{i}"]['file_name'].values[0])
+                        for i in range(test_df.shape[0])]
+        output_file = f"{args.o}/zipcaller_res_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.cnv"
+        os.makedirs(args.o, exist_ok=True)
+        n_rows = merge_cnv_files(args.merge, output_file, test_samples,
+                                 [chr_name for chr_name, chr_len in chr_len_list])
+        print(f'Merged {len(args.merge)} shard outputs: {n_rows} calls in {output_file}')
+        return
+
+    # Every N-th test sample or chromosome of the job
+    shard = args.shard
+    if shard and args.shard_by == 'chromosome':
+        chr_len_list = chr_len_list[shard[0]::shard[1]]
+
+    # Storage type of the standardized depth files
+    nor_dtype = np.dtype(paths.get('nor_dtype', 'float32'))
+
     # The path of baseline file
     baseline_save_path = paths['baseline_save_path']
-    baseline_data = {}
-    for chr_name, chr_len in chr_len_list:
-        file_path = f'{baseline_save_path}/baseline_file_{chr_name}.npz'
-        loaded_data = load_npz_file(file_path)
-        baseline_data[chr_name] = loaded_data[chr_name]
+    st = time.time()
+    baseline_data = open_baseline(baseline_save_path, chr_len_list,
+                                  dtype=np.dtype(paths.get('baseline_dtype', 'float32')))
+    baseline_open_sec = time.time() - st
+    baseline_read_sec = 0
 
     # Log
     log_filename = "log/ZIP-Caller_log.txt"
@@ -164,60 +424,179 @@ def main():
 
     # Output
     output_path = args.o
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    output_file = f'{output_path}/zipcaller_res_{current_datetime}.cnv'
-    json_dir = 'data/nor/'
+    os.makedirs(output_path, exist_ok=True)
+    nor_dir = 'data/nor/'
+
+    # Units recorded by a stopped run with the same settings are skipped, and the output keeps its first name
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint_dir = os.path.join(args.checkpoint, shard_name(shard)) if shard else args.checkpoint
+        checkpoint = Checkpoint(checkpoint_dir, {'script': 'zip_caller.py', 'config': paths, 'windows': slide_wins,
+                                                 'K': K, 'baseline': load_baseline_meta(baseline_save_path),
+                                                 'shard': shard and [args.shard_by, *shard]})
+        current_datetime = checkpoint.run_id
+    # A shard writes under a fixed name, for -merge
+    output_file = f'{output_path}/zipcaller_res_{shard_name(shard) if shard else current_datetime}.cnv'
+
+    # Open every test sample once; legacy JSON files are converted here, before any worker reads them
+    samples = []
+    for i in trange(test_df.shape[0]):
+        if shard and args.shard_by == 'sample' and i % shard[1] != shard[0]:
+            continue
+        mapping = f"sample_{i}"
+        file_name = test_df.loc[test_df['mapping'] == mapping]['file_name'].values[0]
+        print(f'process {file_name} ..................')
+        sample = os.path.basename(file_name)
+        sample_dir = os.path.join(nor_dir, sample.replace('.bam', ''))
+        json_file = sample_dir + '.json'
+        print(sample_dir)
+        if os.path.isdir(sample_dir) or os.path.isfile(json_file):
+            try:
+                with profiler.stage('sample_open', sample=sample):
+                    samples.append((sample, sample_dir, load_std_depth(nor_dir, file_name, dtype=nor_dtype)))
+            except Exception as e:
+                log_error(log_filename, sample, e)
+
+    done_units = set()
+    if checkpoint is not None:
+        done_units = {(sample, chr_name) for sample, sample_dir, mapped_depth in samples
+                      for chr_name, chr_len in chr_len_list
+                      if checkpoint.done(sample, 'call', chr_name,
+                                         call_unit_inputs(sample_dir, baseline_save_path, chr_name))}
 
     # Start ZIP-Caller
+    call_st = time.time()
     with open(output_file, 'w', newline='') as file:
         csv_writer = csv.writer(file, delimiter='\t')
-        csv_writer.writerow(
-            ['SampleID', 'Chromosome', 'Start', 'End', 'LogR_Ratio', 'CNV_Type'])
-        for i in trange(test_df.shape[0]):
-            time.sleep(0.01)
-            mapping = f"sample_{i}"
-            file_name = test_df.loc[test_df['mapping'] == mapping]['file_name'].values[0]
-            print(f'process {file_name} ..................')
-            sample = os.path.basename(file_name)
-            filename_part_ = os.path.basename(file_name).replace('.bam', '.json')
-            json_file = os.path.join(json_dir, filename_part_)
-            print(json_file)
-            if os.path.isfile(json_file):
+        csv_writer.writerow(CNV_COLUMNS)
+        if args.batch > 0:
+            # One samples x positions matrix per (batch, chromosome): the baseline chromosome is read and indexed
+            # once per batch. Rows are written per sample after the whole batch, in the per-sample order.
+            batches = [samples[i:i + args.batch] for i in range(0, len(samples), args.batch)]
+            if args.workers > 1:
+                baseline_files = {chr_name: baseline_data[chr_name].filename for chr_name, chr_len in chr_len_list}
+                executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                               initargs=(baseline_files,))
+            for batch in batches:
+                names = [sample for sample, sample_dir, mapped_depth in batch]
+                dirs = [sample_dir for sample, sample_dir, mapped_depth in batch]
+                # Chromosomes still to be called for some sample of the batch
+                todo = [not all((name, chr_name) in done_units for name in names) for chr_name, chr_len in chr_len_list]
+                if args.workers > 1:
+                    units = [executor.submit(run_profiled, call_batch_chr_worker, dirs, names, chr_name, slide_wins,
+                                             K, bin_size) if todo[chr_idx] else None
+                             for chr_idx, (chr_name, chr_len) in enumerate(chr_len_list)]
+                batch_rows = [[] for _ in batch]
+                failed_samples = set()
+                for chr_idx, (chr_name, chr_len) in enumerate(chr_len_list):
+                    if not todo[chr_idx]:
+                        continue
+                    try:
+                        if args.workers > 1:
+                            (results, read_sec), records = units[chr_idx].result()
+                            profiler.records += records
+                        else:
+                            b, read_sec = read_baseline_chr(baseline_data[chr_name], chr_name)
+                            results = call_batch_chr(dirs, names, chr_name, b, slide_wins, K, bin_size)
+                            del b
+                    except Exception as e:
+                        results = [e] * len(batch)
+                        read_sec = 0
+                    baseline_read_sec += read_sec
+                    for idx, sample_results in enumerate(results):
+                        if names[idx] in failed_samples:
+                            continue
+                        if isinstance(sample_results, Exception):
+                            failed_samples.add(names[idx])
+                            log_error(log_filename, names[idx], sample_results)
+                        elif (names[idx], chr_name) not in done_units:
+                            batch_rows[idx].append((chr_name, sample_results))
+                for name, sample_dir, sample_rows in zip(names, dirs, batch_rows):
+                    for chr_name, results in sample_rows:
+                        write_unit(csv_writer, checkpoint, name, chr_name, results,
+                                   call_unit_inputs(sample_dir, baseline_save_path, chr_name))
+            if args.workers > 1:
+                executor.shutdown()
+        elif args.workers <= 1:
+            for sample, sample_dir, mapped_depth in samples:
                 try:
-                    standardized_depth = load_from_json(json_file)
                     for chr_name, chr_len in chr_len_list:
-                        s = standardized_depth[chr_name]
-                        b = baseline_data[chr_name]
-
-                        cusum_statistic = calcu_win_depth(s, b, slide_win)
-                        ct_up, ct_down = calcu_ct(cusum_statistic, K)
-                        result_up = find_continuous_up_segments(ct_up, H_pos=H_pos, min_length=10000)
-                        result_down = find_continuous_down_segments(ct_down, H_neg=H_neg, min_length=10000)
-
-                        cand_dup_reg = find_cand_dup_regs(result_up)
-                        cand_down_reg = find_cand_del_regs(result_down)
-
-                        if cand_dup_reg:
-                            dup_results = calcu_logr(cand_dup_reg, standardized_depth, baseline_data, chr_name, sample)
-                            for result in dup_results:
-                                csv_writer.writerow(result)
-                        if cand_down_reg:
-                            del_results = calcu_logr(cand_down_reg, standardized_depth, baseline_data, chr_name, sample)
-                            for result in del_results:
-                                csv_writer.writerow(result)
+                        if (sample, chr_name) in done_units:
+                            continue
+                        if args.chunk_size > 0:
+                            write_unit(csv_writer, checkpoint, sample, chr_name,
+                                       call_cnv_stream(mapped_depth[chr_name], baseline_data[chr_name], chr_name,
+                                                       sample, slide_wins, K, bin_size, args.chunk_size),
+                                       call_unit_inputs(sample_dir, baseline_save_path, chr_name))
+                            continue
+                        # Only the chromosome being processed is read from the memory-mapped files
+                        b, read_sec = read_baseline_chr(baseline_data[chr_name], chr_name)
+                        baseline_read_sec += read_sec
+                        write_unit(csv_writer, checkpoint, sample, chr_name,
+                                   call_cnv(mapped_depth[chr_name], b, chr_name, sample, slide_wins, K, bin_size),
+                                   call_unit_inputs(sample_dir, baseline_save_path, chr_name))
+                        del b
                 except Exception as e:
-                    current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    error_message = f"{current_time}:Error occurred while reading {sample}: {e}"
-                    print(error_message)
-                    # Write the error message to the log file
-                    with open(log_filename, "a") as log_file:
-                        log_file.write(error_message + "\n")
+                    log_error(log_filename, sample, e)
                     continue
+        else:
+            # Workers memory-map the baseline files instead of receiving a pickled copy
+            baseline_files = {chr_name: baseline_data[chr_name].filename for chr_name, chr_len in chr_len_list}
+            with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                     initargs=(baseline_files,)) as executor:
+                units = [(sample, sample_dir, chr_name,
+                          executor.submit(run_profiled, call_sample_chr, sample_dir, chr_name, sample, slide_wins, K,
+                                          bin_size, args.chunk_size))
+                         for sample, sample_dir, mapped_depth in samples for chr_name, chr_len in chr_len_list
+                         if (sample, chr_name) not in done_units]
+                # Rows are written in (sample, chromosome) order, as in a serial run;
+                # after an error the rest of that sample is skipped, also as in a serial run
+                failed_samples = set()
+                for sample, sample_dir, chr_name, future in units:
+                    if sample in failed_samples:
+                        future.cancel()
+                        continue
+                    try:
+                        (results, read_sec), records = future.result()
+                        profiler.records += records
+                        baseline_read_sec += read_sec
+                        write_unit(csv_writer, checkpoint, sample, chr_name, results,
+                                   call_unit_inputs(sample_dir, baseline_save_path, chr_name))
+                    except Exception as e:
+                        failed_samples.add(sample)
+                        log_error(log_filename, sample, e)
+
+        if checkpoint is not None:
+            # Fragments of this run and of the runs it resumes, in (sample, chromosome) order
+            checkpoint.merge_rows(file, [(sample, 'call', chr_name) for sample, sample_dir, mapped_depth in samples
+                                         for chr_name, chr_len in chr_len_list])
+            log_message(log_filename, f"Checkpoint: {checkpoint.n_resumed} units restored from "
+                                      f"{checkpoint.manifest_file}")
+
+    mode = f'batches of {args.batch} samples' if args.batch > 0 else 'one sample at a time'
+    if args.chunk_size > 0:
+        mode += f', chunks of {args.chunk_size} positions'
+    log_message(log_filename, f"Calling: {len(samples)} samples in {time.time() - call_st:.2f}sec ({mode}, "
+                              f"{args.workers} workers)")
+    baseline_mb = sum(b.nbytes for b in baseline_data.values()) / 1e6
+    log_message(log_filename, f"Baseline I/O: mapped {baseline_mb:.1f}MB in {baseline_open_sec:.2f}sec, "
+                              f"read {baseline_read_sec:.2f}sec over all (sample, chromosome) units")
 
 
 if __name__ == '__main__':
     st = time.time()
-    main()
+    args = parse_args()
+    # Stage timings, peak RSS and bytes are written next to the log; shards started together each write their
+    # own report
+    report_prefix = f"log/ZIP-Caller_profile_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    if args.shard:
+        report_prefix += f'_{shard_name(args.shard)}'
+    if args.profile:
+        run_with_cprofile(lambda: main(args), report_prefix + '.prof')
+    else:
+        main(args)
+    profiler.write_report(report_prefix, script='zip_caller.py', config=args.config, workers=args.workers,
+                          batch=args.batch, chunk_size=args.chunk_size, windows=sorted(set(args.n)))
     et = time.time()
     rt = et - st
     print(f"Finish! runtime: {rt}sec")